@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""Benchmark kitnirc.contrib.commands' handling of busy-channel traffic.
+
+Compares the current prefix regex and split_args() tokenizer against the
+old approach (trying each prefix with startswith(), then shlex.split()),
+over a simulated channel where most lines are chatter and a few are
+command invocations. Run from the top of the repository:
+
+    python benchmarks/commands_bench.py [messages]
+"""
+import ConfigParser
+import os
+import random
+import shlex
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from kitnirc.client import Channel
+from kitnirc.contrib.commands import CommandsModule, split_args
+
+
+WORDS = "the quick brown fox jumps over lazy dog lol ok yes no what why"
+
+SPLIT_SAMPLES = [
+    "user123",
+    "new york today",
+    '"new york" today',
+]
+
+
+class FakeUser(object):
+    nick = "bot"
+
+
+class FakeClient(object):
+    user = FakeUser()
+
+
+class FakeController(object):
+    """Just enough of a Controller for CommandsModule to start."""
+
+    def __init__(self):
+        self.client = FakeClient()
+        self.config = ConfigParser.SafeConfigParser()
+        self.config.add_section("command")
+        self.config.set("command", "sigil", "!")
+        self.config.set("command", "workers", "0")
+
+    def listen(self, event):
+        pass
+
+    def process_event(self, *args, **kwargs):
+        pass
+
+
+def make_messages(count, seed=2):
+    """Channel traffic with about 8% command invocations."""
+    rng = random.Random(seed)
+    words = WORDS.split()
+    messages = []
+    for i in xrange(count):
+        r = rng.random()
+        if r < 0.03:
+            messages.append('!weather "new york" today')
+        elif r < 0.06:
+            messages.append("!stats user%d" % i)
+        elif r < 0.08:
+            messages.append("bot: help me with %s" % rng.choice(words))
+        else:
+            messages.append(" ".join(rng.choice(words)
+                                     for _ in xrange(rng.randint(3, 15))))
+    return messages
+
+
+def make_module():
+    module = CommandsModule(FakeController())
+    module.start()
+    for command in ("weather", "stats", "help"):
+        module.add_command(None, command, command.upper())
+    return module
+
+
+def run_new(module, channel, messages):
+    found = 0
+    for message in messages:
+        interested, rest = module.check_for_interest(None, channel, message)
+        if interested:
+            event, _ = module.parse_command(rest)
+            if event:
+                found += 1
+    return found
+
+
+def run_old(module, channel, messages):
+    found = 0
+    for message in messages:
+        for prefix in module.prefixes:
+            if message.startswith(prefix):
+                rest = message[len(prefix):]
+                break
+        else:
+            continue
+        command, _, rest = rest.partition(" ")
+        if command.lower() in module.commands:
+            shlex.split(rest.strip())
+            found += 1
+    return found
+
+
+def best_of(func, number=1, repeat=3):
+    """The fastest of several runs of func, in seconds per call."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    module = make_module()
+    channel = Channel("#busy")
+    messages = make_messages(count)
+
+    print "%d messages, %d of them commands" % (
+        count, run_new(module, channel, messages))
+    print "per message, end to end:"
+    for name, func in (("old", run_old), ("new", run_new)):
+        elapsed = best_of(lambda: func(module, channel, messages))
+        print "  %-4s %.2f us" % (name, elapsed / count * 1e6)
+
+    print "per split:"
+    for sample in SPLIT_SAMPLES:
+        old = best_of(lambda: shlex.split(sample), number=10000)
+        new = best_of(lambda: split_args(sample), number=10000)
+        print "  %-20r shlex %.2f us, split_args %.2f us" % (
+            sample, old * 1e6, new * 1e6)
+
+    module.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+# vim: set ts=4 sts=4 sw=4 et:
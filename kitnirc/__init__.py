@@ -5,6 +5,7 @@ import logging
 from kitnirc import client
 from kitnirc import events
 from kitnirc import modular
+from kitnirc import transport
 from kitnirc import user
 
 __version__ = "0.3.1"
@@ -17,6 +18,7 @@ __all__ = [
     "client",
     "events",
     "modular",
+    "transport",
     "user",
 ]
 
@@ -1,25 +1,46 @@
+import base64
+import collections
+import contextlib
+import heapq
 import logging
+import os
 import re
+import select
 import socket
-
-try:
-    import ssl as _ssl
-    _hush_pyflakes = [_ssl]
-    del _hush_pyflakes
-except ImportError:
-    _ssl = None # No SSL support
+import threading
+import time
 
 from kitnirc.events import NUMERIC_EVENTS
-from kitnirc.user import User
+from kitnirc.transport import is_ssl_context, make_ssl_context, make_transport
+from kitnirc.user import MaskIndex, User, users_matching
 
 _log = logging.getLogger(__name__)
 
+# Longest line we'll send, not counting the trailing CRLF (RFC 2812)
+MAX_LINE_LENGTH = 510
+
+# Commands which are dropped rather than sent while the client is shedding
+# load (see Client.send()). Nothing here is needed to stay connected.
+SHEDDABLE_COMMANDS = frozenset([
+    "NOTICE",
+    "WHO",
+    "WHOIS",
+    "WHOWAS",
+    "LIST",
+    "NAMES",
+])
+
 
 class Channel(object):
     """Information about an IRC channel.
 
     This class keeps track of things like who is in a channel, the channel
     topic, modes, and so on.
+
+    List modes (bans, ban exceptions, invite exceptions, ...) are kept in
+    .lists as a MaskIndex per mode character. They are updated as MODE
+    changes are seen, and filled in completely by asking the server for
+    the list (see Client.request_mode_list()).
     """
 
     def __init__(self, name):
@@ -27,6 +48,11 @@ class Channel(object):
         self.topic = None
         self.members = {}
         self.modes = {}
+        self.lists = {} # mode -> MaskIndex
+        # Modes whose whole list has been received from the server, rather
+        # than pieced together from MODE changes
+        self.lists_complete = set()
+        self._lists = {} # Receive buffers; mode -> list of masks
 
     def __str__(self):
         return self.name
@@ -58,6 +84,36 @@ class Channel(object):
         del self.members[user.nick]
         _log.debug("Removed '%s' from channel '%s'", user, self.name)
 
+    def mode_list(self, mode):
+        """The MaskIndex for a list mode (e.g. "b" for bans)."""
+        masks = self.lists.get(mode)
+        if masks is None:
+            masks = self.lists[mode] = MaskIndex()
+        return masks
+
+    def is_banned(self, user, ban_mode="b", except_mode="e"):
+        """Whether a user (or hostmask) matches a ban and no exception.
+
+        Only as much as we know about the user can be checked; members
+        known only from a NAMES reply have no user or host.
+        """
+        bans = self.lists.get(ban_mode)
+        if not bans or not bans.matches(user):
+            return False
+        exceptions = self.lists.get(except_mode)
+        return not (exceptions and exceptions.matches(user))
+
+    def members_matching(self, mask):
+        """The members of the channel who match a hostmask."""
+        return users_matching(mask, self.members.values())
+
+    def banned_members(self, ban_mode="b", except_mode="e"):
+        """The members of the channel who are affected by its bans."""
+        if not self.lists.get(ban_mode):
+            return []
+        return [user for user in self.members.values()
+                if self.is_banned(user, ban_mode, except_mode)]
+
 
 class Host(object):
     """Information about an IRC server.
@@ -133,6 +189,43 @@ class Host(object):
         channel = str(channel).lower()
         return channel in self.channels
 
+    def target_limit(self, command):
+        """How many targets a command may have, per the TARGMAX feature.
+
+        Returns None if the server doesn't advertise a limit.
+        """
+        targmax = self.features.get("TARGMAX")
+        if not targmax:
+            return None
+        for item in str(targmax).split(","):
+            name, _, value = item.partition(":")
+            if name.upper() == command.upper():
+                return int(value) if value else None
+        return None
+
+    def channel_limit(self, channel):
+        """How many more channels like this one we're allowed to join.
+
+        Based on the CHANLIMIT feature (or the older MAXCHANNELS). Returns
+        None if the server doesn't advertise a limit.
+        """
+        chanlimit = self.features.get("CHANLIMIT")
+        if not chanlimit:
+            maxchannels = self.features.get("MAXCHANNELS")
+            if not maxchannels:
+                return None
+            chanlimit = "%s:%s" % (self.features.get("CHANTYPES", "#"),
+                                   maxchannels)
+        for item in str(chanlimit).split(","):
+            prefixes, _, limit = item.partition(":")
+            if str(channel)[:1] not in prefixes:
+                continue
+            if not limit:
+                return None
+            joined = sum(1 for name in self.channels if name[0] in prefixes)
+            return max(int(limit) - joined, 0)
+        return None
+
 
 class Client(object):
     """An IRC client.
@@ -147,9 +240,67 @@ class Client(object):
         else:
             self.server = None
         self.connected = False
-        self.socket = None
+        self.transport = None
         self._stop = False
         self._buffer = ""
+        # While greater than zero, outgoing lines are held in the transport
+        # buffer instead of being sent immediately (see batch()).
+        self._batch_depth = 0
+
+        # Calls handed to the run() loop by other threads (see post()), and
+        # calls scheduled to run on the loop later (see call_later()).
+        self._posted = collections.deque()
+        self._posted_keys = set()
+        self._delayed = []
+        self._delayed_sequence = 0
+        self._loop_lock = threading.Lock()
+        # Writing to this pipe wakes up run() so it notices new calls. It
+        # only exists while run() is running, so that it isn't left open.
+        self._wake_r = self._wake_w = None
+
+        # TLS state which is kept across reconnects, so that the same
+        # context is reused and previous sessions can be resumed.
+        self.ssl_context = None
+        self._ssl_options = None
+        self.tls_handshake_time = None
+        self.tls_session_reused = False
+
+        # SASL credentials for the current connection (see connect()), and
+        # the account we're logged in as, once the server tells us.
+        self.sasl = None
+        self.account = None
+
+        # Seconds between starting connect() and receiving WELCOME.
+        self.registration_latency = None
+        self._connect_started = None
+
+        # The most recently measured round-trip time to the server, in
+        # seconds (kept up to date by e.g. the healthcheck module).
+        self.lag = None
+        # While set, commands in self.sheddable are dropped instead of sent,
+        # to save the server's send queue for traffic that matters.
+        self.shedding = False
+        self.sheddable = set(SHEDDABLE_COMMANDS)
+        self.shed_count = 0
+
+        # Lines waiting to be sent at a limited rate (see send_queued()):
+        # up to send_burst lines at once, then send_rate lines per second.
+        self._outbound = collections.deque()
+        self.send_rate = 0.5
+        self.send_burst = 5
+        self._send_tokens = float(self.send_burst)
+        self._send_refilled = time.time()
+        self._drain_handle = None
+
+        # Parsed CHANMODES and PREFIX features, with the raw values they
+        # were parsed from (see _get_chanmodes() and _get_prefixes()).
+        self._chanmodes = (None, None)
+        self._prefixes = (None, None)
+
+        # Running totals, for monitoring.
+        self.lines_in = 0
+        self.lines_out = 0
+        self.connect_count = 0
 
         # Queues for event dispatching.
         self.event_handlers = {
@@ -168,6 +319,10 @@ class Client(object):
             "RAWLINE": [],
             # Fires whenever we see incoming network activity
             "ACTIVITY": [],
+            # Fires when SASL authentication finishes, successfully or not
+            "SASL": [], # success
+            # Fires when the server answers a PING
+            "PONG": [], # actor, token
 
             ###### IRC-LEVEL EVENTS ######
 
@@ -196,10 +351,21 @@ class Client(object):
             "WHOIS": [],
             # Fires when a channel topic changes
             "TOPIC": [],
+            # Fires when a list mode (e.g. the ban list) has been received
+            "MODELIST": [], # channel, mode
             # Fires when someone invites us to a channel
             "INVITE": [],
+            # Fires when the server refuses to let us join a channel
+            "JOINFAILED": [], # channel, reason, message
         }
 
+    @property
+    def socket(self):
+        """The underlying socket of the current transport, if any."""
+        if self.transport is None:
+            return None
+        return self.transport.socket
+
     def add_handler(self, event, handler):
         """Adds a handler for a particular event.
 
@@ -245,7 +411,7 @@ class Client(object):
         return False
 
     def connect(self, nick, username=None, realname=None, password=None,
-                host=None, port=6667, ssl=None):
+                host=None, port=6667, ssl=None, transport=None, sasl=None):
         """Connect to the server using the specified credentials.
 
         Note: if host is specified here, both the host and port arguments
@@ -253,8 +419,24 @@ class Client(object):
 
         If the 'ssl' argument is boolean true, will use SSL. If it is a
         dictionary, will both use SSL and pass the contents as kwargs to
-        the ssl.wrap_socket() call.
+        the ssl.wrap_socket() call. It may also be an ssl.SSLContext.
+        Either way, the resulting context is kept in .ssl_context and
+        reused by later connect() calls, which will also try to resume the
+        previous TLS session with the same server.
+
+        If the 'transport' argument is specified, it should be an unconnected
+        kitnirc.transport.Transport (e.g. a UnixTransport to talk to a local
+        bouncer), which will be used instead of a TCP/SSL connection. In that
+        case host and port default to those of the transport.
+
+        If the 'sasl' argument is an (account, password) pair, the client
+        will authenticate with SASL PLAIN during registration; if it is the
+        string "EXTERNAL", it will use SASL EXTERNAL (which relies on a
+        client certificate, e.g. via the 'certfile' ssl option). Either
+        way, authentication completes before the WELCOME event fires.
         """
+        if transport is not None and not host and self.server is None:
+            host, port = transport.host, transport.port
         if host:
             self.server = Host(host, port)
         if self.server is None:
@@ -263,32 +445,49 @@ class Client(object):
         self.user = User(nick)
         self.user.username = username or nick
         self.user.realname = realname or username or nick
+        self.sasl = sasl
+        self.account = None
+        self.registration_latency = None
+        self._connect_started = time.time()
 
         _log.info("Connecting to %s as %s ...", self.server.host, nick)
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if ssl and _ssl:
-            ssl_kwargs = ssl if isinstance(ssl, dict) else {}
-            self.socket = _ssl.wrap_socket(self.socket, **ssl_kwargs)
-        elif ssl:
-            _log.error("SSL requested but no SSL support available!")
-            return
-
-        self.socket.connect((self.server.host, self.server.port))
+        if transport is None:
+            try:
+                if ssl:
+                    ssl = self._get_ssl_context(ssl)
+                transport = make_transport(self.server.host, self.server.port,
+                                           ssl, session=self._last_session())
+            except ValueError as e:
+                _log.error("%s", e)
+                return
+
+        transport.connect()
+        self.transport = transport
+        self._buffer = ""
         self.connected = True
+        self.connect_count += 1
 
         _log.info("Connected to %s.", self.server.host)
 
-        # Allow an event handler to supply a password instead, if it wants
-        suppress_password = self.dispatch_event("PASSWORD")
+        self.tls_handshake_time = getattr(transport, "handshake_time", None)
+        self.tls_session_reused = getattr(transport, "session_reused", False)
+        if self.tls_handshake_time is not None:
+            _log.info("TLS handshake took %.3fs (session resumed: %s).",
+                      self.tls_handshake_time, self.tls_session_reused)
+
+        # Everything sent during registration (PASS, CAP, NICK, USER...)
+        # goes out in a single write.
+        with self.batch():
+            # Allow an event handler to supply a password instead, if it wants
+            suppress_password = self.dispatch_event("PASSWORD")
 
-        if password and not suppress_password:
-            # We bypass our own send() function here to avoid logging passwords
-            _log.info("Sending server password.")
-            self.socket.send("PASS %s\r\n" % password)
-            self.server.password = password
+            if password and not suppress_password:
+                _log.info("Sending server password.")
+                self.send_secret("PASS", password)
+                self.server.password = password
 
-        self.dispatch_event('CONNECTED')
+            self.dispatch_event('CONNECTED')
 
     def disconnect(self, msg="Shutting down..."):
         if not self.connected:
@@ -298,47 +497,285 @@ class Client(object):
 
         _log.info("Disconnecting from %s ...", self.server.host)
         self._stop = True
+        self._outbound.clear()
         self.send("QUIT", ":" + msg)
-        try:
-            self.socket.close()
-        except socket.error:
-            pass
+        self.connected = False
+        self.transport.close()
 
     def run(self):
         """Process events such as incoming data.
 
         This method blocks indefinitely. It will only return after the
         connection to the server is closed.
+
+        Besides incoming lines, the loop also runs calls scheduled with
+        call_later() and calls handed over from other threads via post(),
+        so that all event handling happens on this thread.
         """
         self._stop = False # Allow re-starting the event loop
-        while not self._stop:
+        with self._loop_lock:
+            self._wake_r, self._wake_w = os.pipe()
+        wake_r = self._wake_r
+        try:
+            while not self._stop:
+                timeout = self._run_pending()
+                if self._stop:
+                    break
+                buffered = self.transport.has_buffered()
+                if buffered:
+                    timeout = 0
+
+                try:
+                    readable, _, _ = select.select(
+                        [self.transport, wake_r], [], [], timeout)
+                except select.error:
+                    if self._stop:
+                        break
+                    raise
+                if wake_r in readable:
+                    os.read(wake_r, 4096)
+                if self.transport not in readable and not buffered:
+                    continue
+
+                try:
+                    data = self.transport.recv(4096)
+                except socket.error:
+                    if self._stop:
+                        break
+                    raise
+
+                if not data:
+                    _log.info("Connection to %s closed.", self.server.host)
+                    self.connected = False
+                    break
+
+                self._buffer += data
+                lines = self._buffer.split("\n")
+                # Last line may not have been fully read
+                self._buffer = lines.pop()
+                self.lines_in += len(lines)
+                for line in lines:
+                    line = line.rstrip("\r")
+                    _log.debug("%s --> %s", self.server.host, line)
+                    self.dispatch_event("LINE", line)
+                    self.dispatch_event("ACTIVITY")
+        finally:
+            with self._loop_lock:
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+                self._wake_r = self._wake_w = None
+
+    def post(self, func, args=(), key=None):
+        """Arrange for func(*args) to be called by the run() loop.
+
+        This is safe to call from any thread, and is how background threads
+        should interact with the client (sending lines, dispatching events,
+        touching channel state, ...) - the call will happen on the same
+        thread as all other event handling, in the order calls were posted.
+
+        If 'key' is specified and an earlier call posted with the same key
+        is still waiting to run, this call is dropped and False is returned.
+        This lets a producer coalesce repeated work instead of piling it up
+        while the loop is busy. Otherwise returns True.
+        """
+        with self._loop_lock:
+            if key is not None:
+                if key in self._posted_keys:
+                    return False
+                self._posted_keys.add(key)
+            # Written under the lock, so that run() can't close the pipe
+            # in the meantime; if run() isn't running, it will see the
+            # call when it next starts.
+            if not self._posted and self._wake_w is not None:
+                os.write(self._wake_w, "x")
+            self._posted.append((func, args, key))
+        return True
+
+    def post_event(self, event, *args):
+        """Dispatch an event from the run() loop; safe from any thread."""
+        return self.post(self.dispatch_event, (event,) + args)
+
+    def call_later(self, delay, func, *args):
+        """Arrange for func(*args) to be called by the run() loop later.
+
+        The delay is in seconds, and may be fractional. Safe to call from
+        any thread. Returns a handle which can be passed to cancel_call().
+        """
+        with self._loop_lock:
+            self._delayed_sequence += 1
+            handle = [time.time() + delay, self._delayed_sequence, func, args]
+            heapq.heappush(self._delayed, handle)
+            if self._delayed[0] is handle and self._wake_w is not None:
+                os.write(self._wake_w, "x")
+        return handle
+
+    def cancel_call(self, handle):
+        """Cancel a call scheduled with call_later(), if it hasn't run."""
+        handle[2] = None
+
+    def _run_pending(self):
+        """Run posted calls and any delayed calls that are due.
+
+        Returns the number of seconds until the next delayed call is due
+        (or None if there are none).
+        """
+        with self._loop_lock:
+            now = time.time()
+            calls = list(self._posted)
+            self._posted.clear()
+            self._posted_keys.clear()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, func, args = heapq.heappop(self._delayed)
+                if func is not None:
+                    calls.append((func, args, None))
+
+        for func, args, _ in calls:
             try:
-                self._buffer += self.socket.recv(4096)
-            except socket.error:
-                raise
-
-            lines = self._buffer.split("\n")
-            self._buffer = lines.pop() # Last line may not have been fully read
-            for line in lines:
-                line = line.rstrip("\r")
-                _log.debug("%s --> %s", self.server.host, line)
-                self.dispatch_event("LINE", line)
-                self.dispatch_event("ACTIVITY")
-
-    def ping(self):
-        "Convenience method to send a PING to server"
-        self.send("PING " + self.server.host)
+                func(*args)
+            except Exception:
+                _log.exception("Error in call to %r from the event loop.",
+                               func)
+
+        with self._loop_lock:
+            while self._delayed and self._delayed[0][2] is None:
+                heapq.heappop(self._delayed)
+            if self._posted:
+                return 0
+            if not self._delayed:
+                return None
+            return max(self._delayed[0][0] - time.time(), 0)
+
+    def ping(self, token=None):
+        """Convenience method to send a PING to server.
+
+        The server echoes 'token' (by default, its own hostname) back in its
+        PONG, which dispatches the PONG event.
+        """
+        self.send("PING", token or self.server.host)
 
     def send(self, *args):
         """Sends a single raw message to the IRC server.
 
         Arguments are automatically joined by spaces. No newlines are allowed.
+
+        While self.shedding is set, commands in self.sheddable are dropped
+        instead (and False is returned).
+        """
+        if self.shedding and args:
+            command = str(args[0]).partition(" ")[0].upper()
+            if command in self.sheddable:
+                self.shed_count += 1
+                _log.debug("Shedding outgoing %s.", command)
+                return False
+        msg = self._format_line(args)
+        _log.debug("%s <-- %s", self.server.host, msg)
+        self._write(msg)
+
+    def send_secret(self, *args):
+        """Like send(), but only logs the command, not its arguments.
+
+        Use this for lines containing passwords or other credentials.
+        """
+        msg = self._format_line(args)
+        _log.debug("%s <-- %s <redacted>", self.server.host,
+                   msg.partition(" ")[0])
+        self._write(msg)
+
+    def send_queued(self, *args):
+        """Like send(), but subject to rate limiting.
+
+        The line joins a queue which is drained from the run() loop: up to
+        .send_burst lines go out straight away, then .send_rate lines per
+        second, which keeps large amounts of traffic (e.g. mass mode
+        changes) from tripping the server's flood protection. Lines sent
+        with send() skip the queue.
+        """
+        msg = self._format_line(args) # Catch bad lines now, not later
+        self._outbound.append(msg)
+        if self._drain_handle is None:
+            self._drain_outbound()
+
+    @property
+    def queued(self):
+        """The number of lines waiting in the send_queued() queue."""
+        return len(self._outbound)
+
+    def _drain_outbound(self):
+        """Send as many queued lines as the rate limit allows."""
+        self._drain_handle = None
+        if not self.connected:
+            self._outbound.clear()
+            return
+
+        now = time.time()
+        self._send_tokens = min(
+            self.send_burst,
+            self._send_tokens + (now - self._send_refilled) * self.send_rate)
+        self._send_refilled = now
+        with self.batch():
+            while self._outbound and self._send_tokens >= 1:
+                self._send_tokens -= 1
+                self.send(self._outbound.popleft())
+
+        if self._outbound:
+            delay = (1 - self._send_tokens) / self.send_rate
+            self._drain_handle = self.call_later(delay, self._drain_outbound)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager which coalesces outgoing lines into one write.
+
+        Lines sent inside the block are buffered by the transport and
+        flushed together when the outermost batch() block exits:
+
+            with client.batch():
+                client.nick("foo")
+                client.userinfo("foo", "Foo Bar")
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.transport.flush()
+
+    def _get_ssl_context(self, ssl):
+        """Get the shared SSLContext for the given 'ssl' connect() argument.
+
+        A new context is only built if the options have changed since the
+        last connect(); otherwise the existing one is returned.
         """
+        if is_ssl_context(ssl):
+            self.ssl_context = ssl
+            self._ssl_options = None
+        elif self.ssl_context is None or ssl != self._ssl_options:
+            ssl_kwargs = ssl if isinstance(ssl, dict) else {}
+            self.ssl_context = make_ssl_context(**ssl_kwargs)
+            self._ssl_options = ssl
+        return self.ssl_context
+
+    def _last_session(self):
+        """The TLS session from our previous connection to this server."""
+        previous = self.transport
+        if previous is None or previous.host != self.server.host:
+            return None
+        if getattr(previous, "context", None) is not self.ssl_context:
+            return None
+        return getattr(previous, "session", None)
+
+    def _format_line(self, args):
         msg = " ".join(a.nick if isinstance(a, User) else str(a) for a in args)
         if "\n" in msg:
             raise ValueError("Cannot send() a newline. Args: %s" % repr(args))
-        _log.debug("%s <-- %s", self.server.host, msg)
-        self.socket.send(msg + "\r\n")
+        return msg
+
+    def _write(self, msg):
+        """The single path by which all outgoing lines reach the transport."""
+        self.transport.write(msg + "\r\n")
+        self.lines_out += 1
+        if not self._batch_depth:
+            self.transport.flush()
 
     def nick(self, nick):
         """Attempt to set the nickname for this connection."""
@@ -356,11 +793,43 @@ class Client(object):
         _log.info("Requesting user info update: username=%s realname=%s",
             username, realname)
 
-        self.send("USER", username, socket.getfqdn(), self.server.host,
+        # Per RFC 2812 the second and third parameters are the user mode
+        # and an unused field; servers ignore our hostname anyway, so there
+        # is no need to look it up.
+        self.send("USER", username, "0", "*",
             ":%s" % realname) # Realname should always be prefixed by a colon
         self.user.username = username
         self.user.realname = realname
 
+    def sasl_begin(self):
+        """Request the SASL capability and start authenticating.
+
+        Note: this should only be called during registration. (The default
+        on-connect routine calls this automatically if SASL credentials were
+        passed to connect().) The server holds registration until we send
+        CAP END, which happens once authentication succeeds or fails.
+        """
+        mechanism = "EXTERNAL" if self.sasl == "EXTERNAL" else "PLAIN"
+        _log.info("Requesting SASL %s authentication.", mechanism)
+        self.send("CAP", "REQ", ":sasl")
+        self.send("AUTHENTICATE", mechanism)
+
+    def sasl_respond(self):
+        """Send our SASL credentials in response to AUTHENTICATE +."""
+        if self.sasl == "EXTERNAL":
+            self.send("AUTHENTICATE", "+")
+            return
+        account, password = self.sasl
+        payload = base64.b64encode("%s\0%s\0%s" % (account, account, password))
+        # Payloads are sent in chunks of at most 400 bytes; a final chunk
+        # of exactly 400 bytes must be followed by an empty "+" chunk.
+        chunks = [payload[i:i+400] for i in xrange(0, len(payload), 400)]
+        if not chunks or len(chunks[-1]) == 400:
+            chunks.append("+")
+        with self.batch():
+            for chunk in chunks:
+                self.send_secret("AUTHENTICATE", chunk)
+
     def msg(self, target, message):
         """Send a message to a user or channel."""
         self.send("PRIVMSG", target, ":" + message)
@@ -428,6 +897,52 @@ class Client(object):
         self.send("JOIN", target, *([key] if key else []))
         return True
 
+    def join_many(self, channels):
+        """Attempt to join several channels with as few lines as possible.
+
+        The 'channels' argument is a sequence of (channel, key) pairs, where
+        key may be None. Channels are packed into comma-separated JOIN
+        lines, respecting the server's TARGMAX for JOIN as well as the
+        maximum line length, and sent in a single write.
+
+        Returns the list of channels that were requested.
+        """
+        chantypes = self.server.features.get("CHANTYPES", "#")
+        keyed = []
+        unkeyed = []
+        for channel, key in channels:
+            if not channel or channel[0] not in chantypes:
+                _log.warning("Refusing to join channel that does not start "
+                             "with one of '%s': %s", chantypes, channel)
+                continue
+            if self.server.in_channel(channel):
+                _log.warning("Ignoring request to join channel '%s' because "
+                             "we are already in that channel.", channel)
+                continue
+            (keyed if key else unkeyed).append((channel, key))
+
+        # Keys are matched up with channels by position, so channels that
+        # need one have to come first in each line.
+        limit = self.server.target_limit("JOIN")
+        lines = []
+        group = []
+        for item in keyed + unkeyed:
+            candidate = group + [item]
+            if group and ((limit and len(candidate) > limit) or
+                          len(_join_line(candidate)) > MAX_LINE_LENGTH):
+                lines.append(group)
+                candidate = [item]
+            group = candidate
+        if group:
+            lines.append(group)
+
+        with self.batch():
+            for group in lines:
+                _log.info("Joining channels %s ...",
+                          ",".join(channel for channel, _ in group))
+                self.send(_join_line(group))
+        return [channel for channel, _ in keyed + unkeyed]
+
     def invite(self, channel, nick):
         """Attempt to invite a user to a channel."""
         self.send("INVITE", nick, channel)
@@ -459,6 +974,14 @@ class Client(object):
         """Request WHOIS information about a user."""
         self.send("WHOIS", nick)
 
+    def request_mode_list(self, channel, mode="b"):
+        """Ask the server for the full list of a list mode (e.g. bans).
+
+        Once it has arrived, the channel's .lists[mode] is replaced with it
+        and the MODELIST event fires.
+        """
+        self.send("MODE", channel, mode)
+
     def mode(self, channel, add='', remove=''):
         """Add and/or remove modes for a given channel.
 
@@ -511,19 +1034,113 @@ class Client(object):
         remove_modes, remove_modes_args = _arg_to_list(
             remove, list_modes | always_arg_modes, set_arg_modes | toggle_modes)
 
-        max_arg = self.server.features.get("MODES") or 3
-
-        def _send_modes(op, toggle_modes, arg_modes):
-            while toggle_modes or arg_modes:
-                modes = "".join(toggle_modes)
-                toggle_modes = ""
-                now_modes, arg_modes = arg_modes[:max_arg], arg_modes[max_arg:]
-                modes += "".join(mode for mode,arg in now_modes)
-                modes += "".join(" %s" % arg for mode,arg in now_modes)
-                self.send("MODE", channel, "%s%s" % (op, modes))
-
-        _send_modes("+", add_modes, add_modes_args)
-        _send_modes("-", remove_modes, remove_modes_args)
+        changes = [("+", mode, None) for mode in add_modes]
+        changes.extend(("+", mode, arg) for mode, arg in add_modes_args)
+        changes.extend(("-", mode, None) for mode in remove_modes)
+        changes.extend(("-", mode, arg) for mode, arg in remove_modes_args)
+        for line in _pack_modes(channel, changes, self._max_mode_args()):
+            self.send("MODE", channel, line)
+
+    def _max_mode_args(self):
+        """How many argument-taking modes fit in one MODE line."""
+        return self.server.features.get("MODES") or 3
+
+    def bulk_modes(self, changes, queued=True):
+        """Make many channel mode changes in as few MODE lines as possible.
+
+        'changes' is an iterable of (channel, op, mode, argument) tuples,
+        where op is "+" or "-", and argument is None for modes which don't
+        take one - for example:
+
+            client.bulk_modes([("#foo", "+", "b", "*!*@spammer.example"),
+                               ("#bar", "-", "o", "somenick"),
+                               ("#bar", "+", "m", None)])
+
+        Changes which would make no difference according to the tracked
+        state of the channel (banning a mask which is already banned,
+        opping someone who already has ops, ...) are dropped, as are
+        repeats; if the same change is given with both ops, the last one
+        wins. Unbanning a mask we don't know of is only dropped once the
+        channel's ban list has been received in full (see
+        request_mode_list()). Channels we're not in are skipped.
+
+        The remaining changes are packed into MODE lines with as many
+        modes as the server's MODES feature allows and within the line
+        length limit, and sent through the rate-limited queue (see
+        send_queued()) unless 'queued' is false.
+
+        Returns the number of MODE lines sent or queued.
+        """
+        list_modes, always_arg_modes, set_arg_modes, toggle_modes = \
+            self._get_chanmodes()
+        prefix_modes = frozenset(self._get_prefixes().itervalues())
+
+        pending = collections.OrderedDict() # channel -> {(mode, arg): op}
+        for channel, op, mode, argument in changes:
+            channel = str(channel).lower()
+            if op not in ("+", "-"):
+                raise ValueError("Invalid mode operation %r" % op)
+            if not self.server.in_channel(channel):
+                _log.warning("Ignoring mode %s%s in channel '%s' because we "
+                             "are not in that channel.", op, mode, channel)
+                continue
+            if mode in toggle_modes or (mode in set_arg_modes and op == "-"):
+                argument = None
+            elif (mode in list_modes or mode in always_arg_modes or
+                  mode in set_arg_modes or mode in prefix_modes):
+                if argument is None:
+                    _log.warning("Ignoring mode %s%s in channel '%s' because "
+                                 "it is missing its argument.", op, mode,
+                                 channel)
+                    continue
+            else:
+                _log.warning("Ignoring request to set channel mode '%s' "
+                             "because it is not a recognized mode.", mode)
+                continue
+            pending.setdefault(channel, collections.OrderedDict())[
+                (mode, argument)] = op
+
+        send = self.send_queued if queued else self.send
+        count = 0
+        max_arg = self._max_mode_args()
+        for channel, channel_changes in pending.iteritems():
+            chan = self.server.get_channel(channel)
+            needed = [(op, mode, argument)
+                      for (mode, argument), op in channel_changes.iteritems()
+                      if not self._mode_is_set(chan, op, mode, argument,
+                                               list_modes, prefix_modes,
+                                               toggle_modes)]
+            # Removals first, which frees up room in e.g. full ban lists
+            needed.sort(key=lambda change: change[0] != "-")
+            for line in _pack_modes(channel, needed, max_arg):
+                send("MODE", channel, line)
+                count += 1
+        return count
+
+    def _mode_is_set(self, channel, op, mode, argument, list_modes,
+                     prefix_modes, toggle_modes):
+        """Whether a mode change would leave the channel as it already is,
+        as far as we know."""
+        if mode in list_modes:
+            masks = channel.lists.get(mode)
+            present = masks is not None and argument in masks
+            if op == "+":
+                return present
+            return not present and mode in channel.lists_complete
+        if mode in prefix_modes:
+            user = channel.members.get(argument)
+            if user is None:
+                argument = argument.lower()
+                for nick, member in channel.members.iteritems():
+                    if nick.lower() == argument:
+                        user = member
+                        break
+                else:
+                    return True # Not in the channel, so nothing to change
+            return (mode in user.modes) == (op == "+")
+        if mode in toggle_modes or op == "-":
+            return (mode in channel.modes) == (op == "+")
+        return channel.modes.get(mode) == argument
 
 
     def handle(self, event):
@@ -544,42 +1161,104 @@ class Client(object):
         return dec
 
     def _get_prefixes(self):
-        """Get the possible nick prefixes and associated modes for a client."""
+        """Get the possible nick prefixes and associated modes for a client.
+
+        The result is cached until the server's PREFIX feature changes, and
+        must not be modified.
+        """
+        feature_prefixes = self.server.features.get('PREFIX')
+        if self._prefixes[0] == feature_prefixes and self._prefixes[1]:
+            return self._prefixes[1]
         prefixes = {
             "@": "o",
             "+": "v",
         }
-        feature_prefixes = self.server.features.get('PREFIX')
         if feature_prefixes:
             modes = feature_prefixes[1:len(feature_prefixes)//2]
             symbols = feature_prefixes[len(feature_prefixes)//2+1:]
             prefixes = dict(zip(symbols, modes))
+        self._prefixes = (feature_prefixes, prefixes)
         return prefixes
 
     def _get_chanmodes(self):
+        """Get the list, always-argument, set-argument and toggle modes.
+
+        The result is cached until the server's CHANMODES feature changes.
+        """
         chanmodes = self.server.features.get('CHANMODES')
+        if self._chanmodes[0] == chanmodes and self._chanmodes[1]:
+            return self._chanmodes[1]
         if not chanmodes:
             # Defaults from RFC 2811
-            list_modes = set("beI")
-            always_arg_modes = set()
-            set_arg_modes = set("kl")
-            toggle_modes = set("aimnqpsrt")
+            list_modes = frozenset("beI")
+            always_arg_modes = frozenset()
+            set_arg_modes = frozenset("kl")
+            toggle_modes = frozenset("aimnqpsrt")
         else:
-            chanmodes = chanmodes.split(",")
-            list_modes = set(chanmodes[0])
-            always_arg_modes = set(chanmodes[1])
-            set_arg_modes = set(chanmodes[2])
-            toggle_modes = set(chanmodes[3])
-        return list_modes, always_arg_modes, set_arg_modes, toggle_modes
+            groups = chanmodes.split(",")
+            list_modes = frozenset(groups[0])
+            always_arg_modes = frozenset(groups[1])
+            set_arg_modes = frozenset(groups[2])
+            toggle_modes = frozenset(groups[3])
+        result = list_modes, always_arg_modes, set_arg_modes, toggle_modes
+        self._chanmodes = (chanmodes, result)
+        return result
+
+
+def _pack_modes(channel, changes, max_arg):
+    """Pack (op, mode, argument) changes into as few MODE lines as possible.
+
+    Each line has at most 'max_arg' modes with arguments (modes without
+    arguments don't count) and fits within MAX_LINE_LENGTH. Returns a list
+    of the lines' parameters, e.g. ["+bb-o mask1 mask2 nick"].
+    """
+    lines = []
+    base = len("MODE %s " % channel)
+    modes, args, sign, length = "", [], None, base
+
+    for op, mode, argument in changes:
+        arg_length = len(argument) + 1 if argument is not None else 0
+        if modes and ((argument is not None and len(args) >= max_arg) or
+                      length + (op != sign) + len(mode) + arg_length >
+                      MAX_LINE_LENGTH):
+            lines.append(" ".join([modes] + args))
+            modes, args, sign, length = "", [], None, base
+        if op != sign:
+            modes += op
+            sign = op
+            length += 1
+        modes += mode
+        length += len(mode) + arg_length
+        if argument is not None:
+            args.append(argument)
+
+    if modes:
+        lines.append(" ".join([modes] + args))
+    return lines
+
+
+def _join_line(channels):
+    """Build a JOIN line for a list of (channel, key) pairs."""
+    line = "JOIN " + ",".join(channel for channel, _ in channels)
+    keys = [key for _, key in channels if key]
+    if keys:
+        line += " " + ",".join(keys)
+    return line
 
 
 ################################################################################
 # DEFAULT LOW-LEVEL EVENT HANDLERS
 ################################################################################
 def on_connect(client):
-    """Default on-connect actions."""
-    client.nick(client.user.nick)
-    client.userinfo(client.user.username, client.user.realname)
+    """Default on-connect actions.
+
+    All of the registration lines are sent in a single write.
+    """
+    with client.batch():
+        if client.sasl:
+            client.sasl_begin()
+        client.nick(client.user.nick)
+        client.userinfo(client.user.username, client.user.realname)
 
 
 def on_line(client, line):
@@ -757,6 +1436,11 @@ def _parse_welcome(client, command, actor, args):
     """Parse a WELCOME and update user state, then dispatch a WELCOME event."""
     _, _, hostmask = args.rpartition(' ')
     client.user.update_from_hostmask(hostmask)
+    if client._connect_started is not None:
+        client.registration_latency = time.time() - client._connect_started
+        client._connect_started = None
+        _log.info("Registered with %s in %.3fs.", client.server.host,
+                  client.registration_latency)
     client.dispatch_event("WELCOME", hostmask)
 
 
@@ -893,11 +1577,55 @@ def _parse_mode(client, command, actor, args):
                     if mode in chan.modes:
                         del chan.modes[mode]
 
-            # list-type modes (bans+exceptions, invite masks) aren't stored,
-            # but do generate MODE events.
+            # list-type modes (bans+exceptions, invite masks) are kept in
+            # the channel's mask indexes.
+            if mode in list_modes and argument:
+                if op == "+":
+                    chan.mode_list(mode).add(argument)
+                else:
+                    chan.mode_list(mode).discard(argument)
+
             client.dispatch_event("MODE", actor, chan, op, mode, argument)
 
 
+def _list_mode(client, command):
+    """The list mode character that a list numeric is about."""
+    if command in ("BANLIST", "ENDOFBANLIST"):
+        return "b"
+    if command in ("EXCEPTLIST", "ENDOFEXCEPTLIST"):
+        return client.server.features.get("EXCEPTS") or "e"
+    return client.server.features.get("INVEX") or "I"
+
+
+@parser("BANLIST", "EXCEPTLIST", "INVITELIST",
+        "ENDOFBANLIST", "ENDOFEXCEPTLIST", "ENDOFINVITELIST")
+def _parse_mode_list(client, command, actor, args):
+    """Parse the entries of a list mode, and dispatch an event at the end.
+
+    The received list replaces whatever was known about it before.
+    """
+    args = args.split(" :", 1)[0].split()
+    if len(args) < 2:
+        return
+    if not client.server.in_channel(args[1]):
+        return # We don't track channels we aren't in
+    channel = client.server.get_channel(args[1])
+    mode = _list_mode(client, command)
+    buf = channel._lists.setdefault(mode, [])
+
+    if not command.startswith("ENDOF"):
+        if len(args) > 2:
+            buf.append(args[2])
+        return
+
+    channel.lists[mode] = MaskIndex(buf)
+    channel.lists_complete.add(mode)
+    del channel._lists[mode]
+    _log.debug("Received %d %s mode mask(s) for %s.", len(buf), mode,
+               channel)
+    client.dispatch_event("MODELIST", channel, mode)
+
+
 @parser("WHOISUSER", "WHOISCHANNELS", "WHOISIDLE", "WHOISSERVER",
         "WHOISOPERATOR", "WHOISACCOUNT", "WHOISBOT", "WHOISREGNICK",
         "ENDOFWHOIS")
@@ -991,6 +1719,73 @@ def _parse_invite(client, command, actor, args):
     client.dispatch_event("INVITE", actor, target, channel.lower())
 
 
+@parser("PONG")
+def _parse_pong(client, command, actor, args):
+    """Parse a PONG and dispatch an event with the echoed token."""
+    server, _, token = args.partition(" ")
+    client.dispatch_event("PONG", actor, (token or server).lstrip(":"))
+
+
+@parser("CAP")
+def _parse_cap(client, command, actor, args):
+    """Parse a CAP reply, ending capability negotiation if SASL was refused."""
+    _, _, args = args.partition(" ") # Strip off the nick (or *)
+    subcommand, _, caps = args.partition(" ")
+    caps = caps.lstrip(":").split()
+    if subcommand == "NAK" and "sasl" in caps:
+        _log.warning("Server refused the SASL capability.")
+        client.send("CAP", "END")
+        client.dispatch_event("SASL", False)
+
+
+@parser("AUTHENTICATE")
+def _parse_authenticate(client, command, actor, args):
+    """Parse an AUTHENTICATE challenge and send our credentials."""
+    if args == "+" and client.sasl:
+        client.sasl_respond()
+
+
+@parser("LOGGEDIN", "LOGGEDOUT")
+def _parse_loggedin(client, command, actor, args):
+    """Parse LOGGEDIN/LOGGEDOUT and update the client's account."""
+    if command == "LOGGEDOUT":
+        client.account = None
+        return
+    args = args.split(" :", 1)[0]
+    client.account = args.split()[-1]
+    _log.info("Logged in as account '%s'.", client.account)
+
+
+@parser("SASLSUCCESS", "SASLFAIL", "SASLTOOLONG", "SASLABORTED",
+        "SASLALREADY")
+def _parse_sasl_result(client, command, actor, args):
+    """Parse the outcome of SASL authentication and finish registration."""
+    success = command in ("SASLSUCCESS", "SASLALREADY")
+    if success:
+        _log.info("SASL authentication succeeded.")
+    else:
+        _log.error("SASL authentication failed (%s).", command)
+    client.send("CAP", "END")
+    client.dispatch_event("SASL", success)
+
+
+@parser("NOSUCHCHANNEL", "TOOMANYCHANNELS", "CHANNELISFULL", "INVITEONLYCHAN",
+        "BANNEDFROMCHAN", "BADCHANNELKEY", "BADCHANMASK", "UNAVAILRESOURCE",
+        "NOCHANMODES")
+def _parse_join_error(client, command, actor, args):
+    """Parse a channel join error and dispatch a JOINFAILED event.
+
+    Some of these numerics are also used for other purposes (e.g. a nick
+    that is temporarily unavailable); only those about channels count.
+    """
+    chantypes = client.server.features.get("CHANTYPES", "#")
+    args, _, message = args.partition(" :")
+    _, _, channel = args.rpartition(" ")
+    if not channel or channel[0] not in chantypes:
+        return
+    client.dispatch_event("JOINFAILED", channel.lower(), command, message)
+
+
 @parser("NICKNAMEINUSE")
 def _parse_nicknameinuse(client, command, actor, args):
     """Parse a NICKNAMEINUSE message and dispatch an event.
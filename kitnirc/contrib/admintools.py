@@ -2,39 +2,148 @@ import logging
 
 from kitnirc.client import Channel
 from kitnirc.modular import Module
-from kitnirc.user import User
+from kitnirc.user import MaskIndex, User
 
 
 _log = logging.getLogger(__name__)
 
 
-def is_admin(controller, client, actor):
+class AdminACL(object):
+    """A compiled form of the [admins] and [admin_commands] config sections.
+
+    Entries in [admins] can take any of these forms:
+
+    [admins]
+    ; A nick, on any host
+    somenick
+    ; A nick on a particular host
+    somenick = some.host
+    ; A hostmask (with * and ? wildcards), with an optional level
+    someone@*.example.com
+    *!~ops@admin.example.com = 10
+
+    Each admin has a level (1 unless a hostmask entry says otherwise). By
+    default any admin may use any command, but commands can require a
+    higher level:
+
+    [admin_commands]
+    quit = 10
+    load = 5
+
+    Masks without wildcards are looked up in a dictionary; the rest are
+    combined into one regex per level (see kitnirc.user.MaskIndex).
+    """
+
+    def __init__(self, config):
+        self.levels = {} # level -> MaskIndex
+        self.command_levels = {} # command -> required level
+
+        if config.has_section("admins"):
+            defaults = config.defaults()
+            for key, value in config.items("admins", raw=True):
+                if key in defaults:
+                    continue
+                level = 1
+                if "@" in key or "!" in key:
+                    mask = key
+                    if value:
+                        try:
+                            level = int(value)
+                        except ValueError:
+                            pass
+                elif value:
+                    mask = "%s!*@%s" % (key, value)
+                else:
+                    mask = key
+                self.levels.setdefault(level, MaskIndex()).add(mask)
+
+        if config.has_section("admin_commands"):
+            for command, level in config.items("admin_commands", raw=True):
+                try:
+                    self.command_levels[command.lower()] = int(level)
+                except (TypeError, ValueError):
+                    _log.error("Ignoring invalid level %r for command '%s'.",
+                               level, command)
+
+        # Highest levels first, so level() can stop at the first match
+        self.ordered = sorted(self.levels.items(), reverse=True)
+
+    def level(self, actor):
+        """The admin level of a user, or 0 if they aren't an admin."""
+        for level, index in self.ordered:
+            if index.matches(actor):
+                return level
+        return 0
+
+    def required_level(self, command):
+        if command is None:
+            return 1
+        return self.command_levels.get(command.lower(), 1)
+
+    def allows(self, actor, command=None):
+        """Whether a user may use a command (or any command, if None)."""
+        return self.level(actor) >= self.required_level(command)
+
+
+def get_acl(controller):
+    """Get the compiled ACL for the controller's current config.
+
+    The ACL is kept on the controller (as .admin_acl), along with the
+    config entries it was built from, and rebuilt whenever those change -
+    whether the config is loaded again or edited in place.
+    """
+    config = controller.config
+    entries = tuple(tuple(config.items(section, raw=True))
+                    if config.has_section(section) else ()
+                    for section in ("admins", "admin_commands"))
+    cached = getattr(controller, "admin_acl", None)
+    if cached is None or cached[0] != entries:
+        cached = controller.admin_acl = (entries, AdminACL(config))
+    return cached[1]
+
+
+def is_admin(controller, client, actor, command=None):
     """Used to determine whether someone issuing a command is an admin.
 
-    By default, checks to see if there's a line of the type nick=host that
-    matches the command's actor in the [admins] section of the config file,
-    or a key that matches the entire mask (e.g. "foo@bar" or "foo@bar=1").
+    By default, checks the actor against the admins in the [admins]
+    section of the config file (see AdminACL for the format), and, if a
+    command is given, against the level that command requires.
     """
     config = controller.config
     if not config.has_section("admins"):
-        logging.debug("Ignoring is_admin check - no [admins] config found.")
+        _log.debug("Ignoring is_admin check - no [admins] config found.")
         return False
-    for key,val in config.items("admins"):
-        if actor == User(key):
-            logging.debug("is_admin: %r matches admin %r", actor, key)
-            return True
-        if actor.nick.lower() == key.lower() and actor.host.lower() == val.lower():
-            logging.debug("is_admin: %r matches admin %r=%r", actor, key, val)
-            return True
-    logging.debug("is_admin: %r is not an admin.", actor)
+    if get_acl(controller).allows(actor, command):
+        _log.debug("is_admin: %r is allowed to use %s.", actor,
+                   command or "admin commands")
+        return True
+    _log.debug("is_admin: %r is not allowed to use %s.", actor,
+               command or "admin commands")
     return False
 
 
+_default_is_admin = is_admin
+
+
+def check_admin(controller, client, actor, command):
+    """Call is_admin, whether or not it has been replaced by one which
+    predates the command argument (and so only takes three arguments).
+    """
+    check = is_admin
+    if check is _default_is_admin:
+        return check(controller, client, actor, command)
+    try:
+        return check(controller, client, actor, command=command)
+    except TypeError:
+        return check(controller, client, actor)
+
+
 class AdminModule(Module):
     """A KitnIRC module which provides admin functionality.
 
     Customization of what an "admin" is can be done by overriding the
-    is_admin global function in this file.
+    is_admin global function in this file (which is also passed the name
+    of the command being used, as 'command', if it accepts that argument).
     """
 
     @Module.handle("PRIVMSG")
@@ -60,6 +169,7 @@ class AdminModule(Module):
             'quit': self.quit,
             'reload': self.reload,
             'reloadall': self.reloadall,
+            'rehash': self.rehash,
             'load': self.load,
             'unload': self.unload,
         }
@@ -71,7 +181,7 @@ class AdminModule(Module):
 
         # Only pay attention to admins
         actor = User(actor)
-        if not is_admin(self.controller, client, actor):
+        if not check_admin(self.controller, client, actor, command):
             client.reply(recipient, actor, "You are not allowed to do that.")
             return
 
@@ -112,6 +222,10 @@ class AdminModule(Module):
     def reloadall(self, client, args):
         return self.controller.reload_modules()
 
+    def rehash(self, client, args):
+        # Re-read the config file, loading and unloading modules to match
+        return self.controller.load_config()
+
     def load(self, client, args):
         if not args:
             return False
@@ -1,4 +1,5 @@
 import logging
+import time
 
 from kitnirc.modular import Module
 
@@ -6,6 +7,18 @@ from kitnirc.modular import Module
 _log = logging.getLogger(__name__)
 
 
+# Join failures that can go away by themselves (or once someone invites or
+# unbans us), and are therefore worth retrying.
+RETRYABLE_ERRORS = set([
+    "CHANNELISFULL",
+    "INVITEONLYCHAN",
+    "BANNEDFROMCHAN",
+    "TOOMANYCHANNELS",
+    "UNAVAILRESOURCE",
+    "NOCHANMODES",
+])
+
+
 class AutoJoinModule(Module):
     """A KitnIRC module which auto-joins a set of channels on connect.
 
@@ -32,8 +45,83 @@ class AutoJoinModule(Module):
 
     (This would join the #foo channel with no key, the #bar channel with
     a key of 'baz', and the ##qux channel with no key.)
+
+    Channels are joined several at a time with comma-separated JOIN lines
+    (as many per line as the server's TARGMAX allows), one line every few
+    seconds, and without exceeding the server's CHANLIMIT. Each channel is
+    tracked until the server confirms the join; joins that fail for
+    reasons which might be temporary (e.g. the channel is full or we are
+    banned) are retried with exponential backoff. The pacing can be tuned
+    in the [autojoin] section:
+
+    [autojoin]
+    ; Seconds between JOIN lines
+    interval = 1
+    ; Channels per JOIN line, if the server doesn't specify
+    batch = 10
+    ; Attempts per channel before giving up
+    retries = 5
+    ; Seconds before the first retry, doubled for each later one
+    backoff = 30
+    ; Seconds to wait for the server to answer a JOIN before resending it
+    timeout = 60
+
+    Outgoing events:
+      AUTOJOIN      joined pending failed
+
+    The AUTOJOIN event reports progress (as counts of channels) each time
+    a join succeeds or fails.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(AutoJoinModule, self).__init__(*args, **kwargs)
+        config = self.controller.config
+
+        def get_option(name, default):
+            if config.has_option("autojoin", name):
+                return config.getfloat("autojoin", name)
+            return default
+
+        self.interval = get_option("interval", 1.0)
+        self.batch = int(get_option("batch", 10))
+        self.max_attempts = int(get_option("retries", 5))
+        self.backoff = get_option("backoff", 30.0)
+        self.timeout = get_option("timeout", 60.0)
+
+        # All of the following are keyed by lowercased channel name.
+        self.queue = [] # (channel, key) pairs not yet sent, in order
+        self.waiting = {} # channel -> (key, time sent)
+        self.retries = {} # channel -> (key, time to retry)
+        self.attempts = {}
+        self.joined = set()
+        self.failed = {} # channel -> reason
+
+        # Handle for the next pacing tick, scheduled on the client loop
+        self.tick_handle = None
+
+    def stop(self, *args, **kwargs):
+        super(AutoJoinModule, self).stop(*args, **kwargs)
+        if self.tick_handle is not None:
+            self.controller.client.cancel_call(self.tick_handle)
+            self.tick_handle = None
+
+    def tick(self):
+        """Send the next JOIN line, then schedule the next tick if needed."""
+        self.tick_handle = None
+        self.send_next()
+        if self.pending:
+            self.schedule_tick()
+
+    def schedule_tick(self):
+        if self.tick_handle is None:
+            self.tick_handle = self.controller.client.call_later(
+                self.interval, self.tick)
+
+    @property
+    def pending(self):
+        """How many channels have yet to be joined (or given up on)."""
+        return len(self.queue) + len(self.waiting) + len(self.retries)
+
     @Module.handle("WELCOME")
     def join_channels(self, client, hostmask):
         config = self.controller.config
@@ -43,9 +131,7 @@ class AutoJoinModule(Module):
             return
 
         chantypes = client.server.features.get("CHANTYPES", "#")
-        count = 0
-
-        _log.info("Beginning automatic channel joins...")
+        channels = []
 
         for channel, key in config.items("channels"):
             # We add a # prefix to any channel that doesn't start with a
@@ -56,10 +142,120 @@ class AutoJoinModule(Module):
                 channel = channel[1:]
             elif channel[0] not in chantypes:
                 channel = "#" + channel
-            client.join(channel, key)
-            count += 1
+            channels.append((channel.lower(), key))
+
+        self.queue = channels
+        self.waiting = {}
+        self.retries = {}
+        self.attempts = {}
+        self.joined = set()
+        self.failed = {}
+
+        _log.info("Beginning automatic joins of %d channel(s)...",
+                  len(channels))
+        self.send_next()
+        self.schedule_tick()
+
+    def send_next(self):
+        """Send the next JOIN line, if it's time to."""
+        client = self.controller.client
+        if not client.connected:
+            return
+        now = time.time()
+
+        # Channels whose retry delay has passed go back in the queue
+        for channel, (key, when) in self.retries.items():
+            if when <= now:
+                del self.retries[channel]
+                self.queue.append((channel, key))
+
+        # As do channels the server never told us about (including any
+        # that join_many() had to leave out), up to the same limit on
+        # attempts as for failures the server did tell us about
+        gave_up = False
+        for channel, (key, sent) in self.waiting.items():
+            if now - sent > self.timeout:
+                del self.waiting[channel]
+                if self.attempts.get(channel, 1) < self.max_attempts:
+                    _log.info("No answer to joining %s; trying again.",
+                              channel)
+                    self.queue.append((channel, key))
+                else:
+                    self.failed[channel] = "TIMEOUT"
+                    _log.warning("Giving up on joining %s (no answer).",
+                                 channel)
+                    gave_up = True
+        if gave_up:
+            self.report(client)
+
+        if not self.queue:
+            return
+
+        count = client.server.target_limit("JOIN") or self.batch
+        limit = client.server.channel_limit(self.queue[0][0])
+        if limit is not None:
+            count = min(count, limit - len(self.waiting))
+            if count <= 0:
+                if not self.waiting:
+                    for channel, _ in self.queue:
+                        self.failed[channel] = "CHANLIMIT"
+                    _log.warning("Not joining %d channel(s) because of "
+                                 "the server's channel limit.",
+                                 len(self.queue))
+                    self.queue = []
+                return
+
+        channels = []
+        for channel, key in self.queue[:count]:
+            if client.server.in_channel(channel):
+                self.joined.add(channel)
+                continue
+            self.waiting[channel] = (key, now)
+            self.attempts[channel] = self.attempts.get(channel, 0) + 1
+            channels.append((channel, key))
+        del self.queue[:count]
+
+        if channels:
+            client.join_many(channels)
+
+    def report(self, client):
+        """Trigger the AUTOJOIN progress event."""
+        pending = self.pending
+        if not pending:
+            _log.info("Auto-join complete: %d joined, %d failed.",
+                      len(self.joined), len(self.failed))
+        self.trigger_event("AUTOJOIN", client,
+                           [len(self.joined), pending, len(self.failed)])
+
+    @Module.handle("JOIN")
+    def confirm_join(self, client, actor, channel):
+        if actor.nick != client.user.nick:
+            return
+        channel = str(channel)
+        if channel not in self.waiting and channel not in self.retries:
+            return # Not one of ours
+        self.waiting.pop(channel, None)
+        self.retries.pop(channel, None)
+        self.joined.add(channel)
+        self.report(client)
 
-        _log.info("Auto-join to %d channel(s) complete.", count)
+    @Module.handle("JOINFAILED")
+    def join_failed(self, client, channel, reason, message):
+        entry = self.waiting.pop(channel, None)
+        if entry is None:
+            return # Not one of ours
+        key, _ = entry
+        attempts = self.attempts.get(channel, 1)
+        if reason in RETRYABLE_ERRORS and attempts < self.max_attempts:
+            delay = self.backoff * 2 ** (attempts - 1)
+            self.retries[channel] = (key, time.time() + delay)
+            _log.info("Couldn't join %s (%s); retrying in %ds.",
+                      channel, reason, delay)
+        else:
+            self.failed[channel] = reason
+            _log.warning("Giving up on joining %s (%s: %s).",
+                         channel, reason, message)
+        self.report(client)
 
 
 module = AutoJoinModule
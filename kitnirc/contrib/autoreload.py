@@ -0,0 +1,246 @@
+import logging
+import os
+import sys
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None # Changes are found by polling instead
+
+from kitnirc.modular import Module
+
+
+_log = logging.getLogger(__name__)
+
+
+def source_file(module_name):
+    """The path of a module's source file, if it has one."""
+    module = sys.modules.get(module_name)
+    path = getattr(module, "__file__", None)
+    if not path:
+        return None
+    base, ext = os.path.splitext(path)
+    if ext in (".pyc", ".pyo"):
+        path = base + ".py"
+    return os.path.abspath(path)
+
+
+if pyinotify is not None:
+    class ChangeHandler(pyinotify.ProcessEvent):
+        """Passes inotify events on to the module, on the client's thread."""
+
+        def my_init(self, module=None):
+            self.module = module
+
+        def process_default(self, event):
+            client = self.module.controller.client
+            client.post(self.module.file_changed, (event.pathname,))
+
+
+class AutoReloadModule(Module):
+    """A KitnIRC module which reloads other modules when they change.
+
+    The source files of loaded modules are watched, and when one changes,
+    that module (and only that module) is reloaded via the controller's
+    reload_module(). Changes are found with inotify if the pyinotify
+    package is installed, and otherwise by checking modification times
+    every few seconds.
+
+    Saving a file often touches it several times in quick succession, and
+    editors may save several files at once; so reloads wait until nothing
+    has changed for a moment, and then each changed module is reloaded
+    once. How long each reload took is logged (and kept in this module's
+    .reload_times).
+
+    The config file can be watched too, in which case changes to it are
+    applied with the controller's load_config().
+
+    [autoreload]
+    ; Seconds to wait after a change before reloading
+    debounce = 1
+    ; Seconds between checks, when polling
+    interval = 2
+    ; Whether to use inotify, if it's available
+    inotify = true
+    ; Whether to watch the config file as well
+    config = false
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AutoReloadModule, self).__init__(*args, **kwargs)
+        config = self.controller.config
+
+        def get_option(name, default):
+            if config.has_option("autoreload", name):
+                return config.getfloat("autoreload", name)
+            return default
+
+        def get_flag(name, default):
+            if config.has_option("autoreload", name):
+                return config.getboolean("autoreload", name)
+            return default
+
+        self.debounce = get_option("debounce", 1.0)
+        self.interval = get_option("interval", 2.0)
+        self.use_inotify = get_flag("inotify", True) and pyinotify is not None
+        self.watch_config = get_flag("config", False)
+
+        self.mtimes = {} # path -> modification time last seen
+        self.changed = set() # modules waiting to be reloaded
+        self.config_changed = False
+        self.reload_times = {} # module -> seconds its last reload took
+
+        self.poll_handle = None
+        self.reload_handle = None
+        self.notifier = None
+        self.watches = None
+        self.directories = set()
+
+    def start(self, *args, **kwargs):
+        super(AutoReloadModule, self).start(*args, **kwargs)
+        if self.use_inotify:
+            self.watches = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(
+                self.watches, ChangeHandler(module=self))
+            self.notifier.daemon = True
+            self.notifier.start()
+            self.update_watches()
+            _log.info("Watching for module changes with inotify.")
+        else:
+            self.update_watches()
+            self.schedule_poll()
+            _log.info("Watching for module changes every %ss.", self.interval)
+
+    def stop(self, *args, **kwargs):
+        super(AutoReloadModule, self).stop(*args, **kwargs)
+        client = self.controller.client
+        for handle in (self.poll_handle, self.reload_handle):
+            if handle is not None:
+                client.cancel_call(handle)
+        self.poll_handle = self.reload_handle = None
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def watched_files(self):
+        """The files being watched: path -> module name (None for config)."""
+        files = {}
+        for module_name in self.controller.loaded_modules:
+            path = source_file(module_name)
+            if path is not None:
+                files[path] = module_name
+        if self.watch_config and self.controller.config_path:
+            files[os.path.abspath(self.controller.config_path)] = None
+        return files
+
+    def update_watches(self):
+        """Note the current state of the watched files.
+
+        Files seen for the first time (e.g. of newly loaded modules) are
+        only noted, not treated as changed.
+        """
+        files = self.watched_files()
+        for path in files:
+            if path not in self.mtimes:
+                self.mtimes[path] = self.mtime(path)
+        for path in self.mtimes.keys():
+            if path not in files:
+                del self.mtimes[path]
+
+        if self.watches is not None:
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+            for directory in set(os.path.dirname(path) for path in files):
+                if directory not in self.directories:
+                    self.watches.add_watch(directory, mask)
+                    self.directories.add(directory)
+        return files
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def schedule_poll(self):
+        self.poll_handle = self.controller.client.call_later(
+            self.interval, self.poll)
+
+    def poll(self):
+        self.poll_handle = None
+        files = self.update_watches()
+        for path in files:
+            self.file_changed(path, files)
+        self.schedule_poll()
+
+    @Module.handle("STARTUP")
+    def startup(self, client, *args):
+        # Modules may have been loaded or unloaded
+        self.update_watches()
+
+    def file_changed(self, path, files=None):
+        """Check a (possibly) changed file, and schedule a reload if needed."""
+        if files is None:
+            files = self.watched_files()
+        if path not in files:
+            return
+        mtime = self.mtime(path)
+        if mtime is None or mtime == self.mtimes.get(path):
+            return
+        self.mtimes[path] = mtime
+
+        module_name = files[path]
+        if module_name is None:
+            self.config_changed = True
+        else:
+            self.changed.add(module_name)
+        _log.debug("%s changed; reloading in %ss unless it changes again.",
+                   path, self.debounce)
+
+        client = self.controller.client
+        if self.reload_handle is not None:
+            client.cancel_call(self.reload_handle)
+        self.reload_handle = client.call_later(self.debounce, self.reload)
+
+    def reload(self):
+        self.reload_handle = None
+        changed, self.changed = self.changed, set()
+        config_changed, self.config_changed = self.config_changed, False
+        controller = self.controller
+
+        if config_changed:
+            started = time.time()
+            if controller.load_config():
+                _log.info("Reloaded config in %.3fs.", time.time() - started)
+            self.update_watches()
+
+        own_name = None
+        for module_name, module in controller.loaded_modules.iteritems():
+            if module is self:
+                own_name = module_name
+        if own_name is None:
+            return # This module was unloaded by the new config
+
+        # In the usual order, but this module last, since reloading it
+        # stops it.
+        ordering = [name for name in controller.module_ordering
+                    if name in changed and name != own_name]
+        if own_name in changed:
+            ordering.append(own_name)
+        for module_name in ordering:
+            started = time.time()
+            success = controller.reload_module(module_name)
+            elapsed = time.time() - started
+            self.reload_times[module_name] = elapsed
+            if success:
+                _log.info("Reloaded module '%s' in %.3fs.",
+                          module_name, elapsed)
+            else:
+                _log.error("Unable to reload changed module '%s'.",
+                           module_name)
+
+
+module = AutoReloadModule
+
+
+# vim: set ts=4 sts=4 sw=4 et:
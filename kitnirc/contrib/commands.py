@@ -1,13 +1,261 @@
+import collections
 import logging
-import shlex
+import Queue
+import re
+import threading
+import time
 
 from kitnirc.client import Channel
 from kitnirc.modular import Module
+from kitnirc.user import User, split_hostmask
 
 
 _log = logging.getLogger(__name__)
 
 
+# A shell-style word: runs of unquoted characters, quoted strings and
+# backslash escapes, with no whitespace between them.
+_WORD_RE = re.compile(r"""(?:[^\s'"\\]+|'[^']*'|"(?:[^"\\]|\\.)*"|\\.)+""",
+                      re.S)
+# The pieces of a word: unquoted, 'single-quoted', "double-quoted", \x
+_PART_RE = re.compile(r"""[^'"\\]+|'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)""",
+                      re.S)
+_DQ_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+
+def _unquote(word):
+    parts = []
+    for match in _PART_RE.finditer(word):
+        single, double, escaped = match.groups()
+        if single is not None:
+            parts.append(single)
+        elif double is not None:
+            parts.append(_DQ_ESCAPE_RE.sub(r"\1", double))
+        elif escaped is not None:
+            parts.append(escaped)
+        else:
+            parts.append(match.group(0))
+    return "".join(parts)
+
+
+def split_args(string):
+    """Split a string into arguments the way shlex.split() would.
+
+    Quotes and backslashes follow POSIX shell rules; a string containing
+    neither is simply split on whitespace. Raises ValueError on an
+    unterminated quote or a trailing backslash.
+    """
+    if '"' not in string and "'" not in string and "\\" not in string:
+        return string.split()
+
+    args = []
+    end = 0
+    for match in _WORD_RE.finditer(string):
+        if string[end:match.start()].strip():
+            break # Something that isn't a valid word
+        word = match.group(0)
+        if '"' in word or "'" in word or "\\" in word:
+            word = _unquote(word)
+        args.append(word)
+        end = match.end()
+    if string[end:].strip():
+        raise ValueError("Unterminated quote or escape in %r" % string)
+    return args
+
+
+class RateLimiter(object):
+    """Token bucket rate limiting for any number of keys.
+
+    Each key may be used 'count' times in a burst, and regains one use
+    every period/count seconds. Updating a key is O(1). Buckets are kept in
+    order of last use, so those left alone for a whole period (which have
+    refilled completely, and so are no different from new ones) are
+    dropped from the front as they expire.
+    """
+
+    def __init__(self, count, period):
+        self.capacity = float(count)
+        self.period = float(period)
+        self.rate = self.capacity / self.period
+        self.buckets = collections.OrderedDict() # key -> [tokens, updated]
+
+    @classmethod
+    def from_string(cls, spec):
+        """Create a RateLimiter from a "count/seconds" string, e.g. "5/60"."""
+        count, _, period = spec.partition("/")
+        count, period = int(count), float(period or 1)
+        if count < 1 or period <= 0:
+            raise ValueError("Invalid rate limit %r" % spec)
+        return cls(count, period)
+
+    def expire(self, now):
+        while self.buckets:
+            key = next(iter(self.buckets))
+            if now - self.buckets[key][1] < self.period:
+                break
+            del self.buckets[key]
+
+    def tokens(self, key, now):
+        """How many uses a key has left."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        return min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def allows(self, key, now):
+        return self.tokens(key, now) >= 1
+
+    def take(self, key, now):
+        """Use up one of a key's tokens."""
+        tokens = self.tokens(key, now) - 1
+        self.buckets.pop(key, None)
+        self.buckets[key] = [tokens, now]
+        self.expire(now)
+
+
+class RecordingClient(object):
+    """A stand-in for a Client which records the messages sent through it.
+
+    Everything is passed through to the real client; calls to the methods
+    in RECORDED are also noted in .calls, so that they can be replayed
+    later (see CommandsModule.replay()).
+    """
+
+    RECORDED = frozenset(["msg", "reply", "notice", "ctcp", "emote",
+                          "send", "send_queued"])
+
+    def __init__(self, client):
+        self._client = client
+        self.calls = [] # (method name, args, kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self.RECORDED:
+            return attr
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        return record
+
+
+class Invocation(object):
+    """A single invocation of a deferred command.
+
+    Handlers of deferred commands are passed one of these in place of the
+    usual actor and recipient. A handler can answer straight away, as any
+    other command would, or call defer() (or run_in_thread()) to leave the
+    invocation pending and answer later, from any thread, with reply(),
+    complete() or fail(). Answers always go back to whoever invoked the
+    command, wherever they invoked it.
+
+    A pending invocation that takes longer than 'working' seconds gets a
+    "still working" notice sent to the invoker, and one that takes longer
+    than 'timeout' seconds is abandoned with an apology; anything it tries
+    to say after that is dropped.
+    """
+
+    def __init__(self, module, client, command, actor, recipient, args):
+        self.module = module
+        self.client = client
+        self.command = command
+        self.actor = actor
+        self.recipient = recipient
+        self.args = args
+        self.timeout = module.deferred_timeout
+        self.started = time.time()
+        self.pending = False
+        self.done = False
+        self._timers = []
+
+    @property
+    def nick(self):
+        return split_hostmask(str(self.actor))[0]
+
+    def defer(self):
+        """Leave the invocation pending once the handler returns.
+
+        This must be called from the handler itself (i.e. on the client's
+        thread); once deferred, the invocation must eventually be finished
+        with complete() or fail(), or it will time out.
+        """
+        if self.pending or self.done:
+            return
+        self.pending = True
+        self.module.pending.add(self)
+        client = self.client
+        if self.module.working_notice:
+            self._timers.append(client.call_later(
+                self.module.working_notice, self._still_working))
+        if self.timeout:
+            self._timers.append(client.call_later(self.timeout,
+                                                  self._timed_out))
+
+    def run_in_thread(self, func, *args):
+        """Defer the invocation and run func(*args) on a worker thread.
+
+        The invocation is completed with func's return value (a message,
+        or None to say nothing more), or failed if it raises.
+        """
+        self.defer()
+        self.module.work.put((self, func, args))
+
+    def reply(self, message):
+        """Reply to the invoker. Safe to call from any thread."""
+        self.client.post(self._reply, (message,))
+
+    def notice(self, message):
+        """Send the invoker a notice. Safe to call from any thread."""
+        self.client.post(self._notice, (message,))
+
+    def complete(self, message=None):
+        """Finish the invocation, optionally with a final reply."""
+        self.client.post(self._complete, (message,))
+
+    def fail(self, message="Sorry, something went wrong."):
+        """Finish the invocation with an apology."""
+        self.client.post(self._complete, (message,))
+
+    # The rest of these run on the client's thread.
+
+    def _reply(self, message):
+        if self.done:
+            return
+        self.client.reply(self.recipient, self.actor, message)
+
+    def _notice(self, message):
+        if self.done:
+            return
+        self.client.notice(self.nick, message)
+
+    def _complete(self, message):
+        if self.done:
+            return
+        if message:
+            self._reply(message)
+        self._finish()
+
+    def _finish(self):
+        self.done = True
+        self.pending = False
+        self.module.pending.discard(self)
+        for handle in self._timers:
+            self.client.cancel_call(handle)
+        self._timers = []
+
+    def _still_working(self):
+        if self.done:
+            return
+        self._notice("Still working on '%s'..." % self.command)
+
+    def _timed_out(self):
+        if self.done:
+            return
+        _log.warning("'%s' invocation by %s timed out after %ds.",
+                     self.command, self.actor, time.time() - self.started)
+        self._reply("Sorry, that took too long.")
+        self._finish()
+
+
 class CommandsModule(Module):
     """A KitnIRC module which provides command dispatch.
 
@@ -22,6 +270,61 @@ class CommandsModule(Module):
     in PMs, any other invocation must be prefixed by the sigil
     or the current nick and a separator.
 
+    ADDCOMMAND may pass a dictionary of options after the help
+    text. The "args" option chooses how the command's arguments
+    are split:
+      "shell"   shell-style, with quoting (the default)
+      "split"   on whitespace only; quotes are left alone
+      "raw"     not at all - the rest of the line is passed as a
+                single argument (if there is anything there)
+
+    Invocations can be rate limited per user (by host), per channel
+    and per command, each as a number of uses in a number of
+    seconds (a burst of that many, then a steady rate):
+
+    [command]
+    user_limit = 5/30
+    channel_limit = 20/30
+    command_limit = 30/60
+
+    The "limit" option of ADDCOMMAND overrides command_limit for a
+    particular command, in the same format. Invocations over a limit
+    are dropped (with a notice to the user, unless limit_notice is
+    set to false) without their command's event being triggered.
+
+    The "cache" option of ADDCOMMAND (a number of seconds) caches
+    the command's responses: the messages its handler sends are
+    recorded, and for that many seconds, invoking the command again
+    with the same arguments in the same channel (or in any PM)
+    replays them - addressed to the new invoker - instead of
+    triggering the event again. Only use this for commands whose
+    response doesn't depend on who is asking. At most cache_size
+    (by default 256) responses are kept, least recently used ones
+    being dropped first:
+
+    [command]
+    cache_size = 256
+
+    Other modules can drop cached responses (e.g. when the data
+    behind them changes) with the INVALIDATECOMMAND event, for a
+    whole command or just one set of arguments.
+
+    Commands which may take a while should set the "deferred"
+    option. Their events are triggered with an Invocation in place
+    of the actor and recipient, which the handler can leave pending
+    (or hand to a worker thread with run_in_thread()) and answer
+    later without holding up anything else. Pending invocations get
+    a "still working" notice after working_notice seconds, and are
+    given up on after deferred_timeout seconds (the "timeout" option
+    of ADDCOMMAND overrides this for a particular command); either
+    can be set to 0 to disable it. Deferred commands aren't cached.
+
+    [command]
+    ; Threads available for run_in_thread()
+    workers = 4
+    working_notice = 5
+    deferred_timeout = 60
+
     This module also triggers the COMMANDS event if it needs other
     modules to re-register their commands (e.g. after this module
     has been reloaded).
@@ -31,18 +334,26 @@ class CommandsModule(Module):
     unlinking a command that a different module won the race for.
 
     Incoming events:
-      ADDCOMMAND    command event [helptext]
+      ADDCOMMAND    command event [helptext [options]]
       REMOVECOMMAND command event
+      INVALIDATECOMMAND command [args]
 
     Outgoing events:
       COMMANDS      n/a
-      *             command args...
+      *             actor recipient args...
+                    (invocation args... for deferred commands)
     """
 
+    provides = ("commands",)
+
 
     def __init__(self, *args, **kwargs):
         super(CommandsModule, self).__init__(*args, **kwargs)
         self.prefixes = set()
+        self.prefix_re = None
+        self.pending = set() # Deferred invocations yet to finish
+        self.work = Queue.Queue() # (invocation, func, args) for the workers
+        self.workers = []
 
     def start(self, *args, **kwargs):
         super(CommandsModule, self).start(*args, **kwargs)
@@ -55,10 +366,82 @@ class CommandsModule(Module):
         else:
             self.sigil = None
 
+        def get_limit(name):
+            if not config.has_option("command", name):
+                return None
+            try:
+                return RateLimiter.from_string(config.get("command", name))
+            except ValueError:
+                _log.error("Ignoring invalid [command] %s setting.", name)
+                return None
+
+        self.user_limit = get_limit("user_limit")
+        self.channel_limit = get_limit("channel_limit")
+        self.command_limit = get_limit("command_limit")
+        self.command_limits = {} # command -> RateLimiter, from ADDCOMMAND
+        if config.has_option("command", "limit_notice"):
+            self.limit_notice = config.getboolean("command", "limit_notice")
+        else:
+            self.limit_notice = True
+        # Users are told they're being rate limited at most once a minute
+        self.notice_limit = RateLimiter(1, 60)
+
+        if config.has_option("command", "cache_size"):
+            self.cache_size = config.getint("command", "cache_size")
+        else:
+            self.cache_size = 256
+        # (command, args, channel) -> (expiry time, recorded calls), in
+        # order of last use
+        self.cache = collections.OrderedDict()
+
+        def get_option(name, default):
+            if config.has_option("command", name):
+                return config.getfloat("command", name)
+            return default
+
+        self.working_notice = get_option("working_notice", 5.0)
+        self.deferred_timeout = get_option("deferred_timeout", 60.0)
+        for i in range(int(get_option("workers", 4))):
+            thread = threading.Thread(target=self.worker,
+                                      name="commands-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
         if hasattr(self.controller.client, "user"):
             self.regenerate_prefixes()
         self.request_commands(self.controller.client)
 
+    def stop(self, *args, **kwargs):
+        super(CommandsModule, self).stop(*args, **kwargs)
+        for invocation in list(self.pending):
+            invocation._finish()
+        for thread in self.workers:
+            self.work.put(None)
+        # Workers busy with long-running commands are left to finish on
+        # their own; they're daemon threads, and whatever they have to say
+        # is dropped now that their invocations are done.
+        for thread in self.workers:
+            thread.join(0.1)
+        self.workers = []
+
+    def worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            invocation, func, args = item
+            if invocation.done:
+                continue # Timed out while waiting its turn
+            try:
+                result = func(*args)
+            except Exception:
+                _log.exception("Error running '%s' invocation.",
+                               invocation.command)
+                invocation.fail()
+            else:
+                invocation.complete(result)
+
     @Module.handle("STARTUP")
     def request_commands(self, client, *args):
         # Broadcast the event which instructs other modules to register
@@ -80,12 +463,18 @@ class CommandsModule(Module):
         self.prefixes.update([p.lower() for p in self.prefixes])
         if self.sigil:
             self.prefixes.add(self.sigil)
+        # All of the prefixes are checked at once with a single regex; the
+        # longest are tried first, so that the match is the same whatever
+        # order the set is in.
+        self.prefix_re = re.compile("|".join(
+            re.escape(prefix) for prefix in
+            sorted(self.prefixes, key=len, reverse=True)))
 
     def check_for_interest(self, client, recipient, message):
         """Determine whether this line is addressing us."""
-        for prefix in self.prefixes:
-            if message.startswith(prefix):
-                return True, message[len(prefix):]
+        match = self.prefix_re.match(message) if self.prefix_re else None
+        if match:
+            return True, message[match.end():]
 
         # Don't require a prefix if addressed in PM.
         # This comes after the prefix checks because
@@ -96,17 +485,42 @@ class CommandsModule(Module):
 
         return False, None
 
-    def parse_command(self, string):
-        """Parse out any possible valid command from an input string."""
+    def find_command(self, string):
+        """Split an input string into a known command's name and the rest.
+
+        Returns None, None if the string doesn't start with a command.
+        """
         possible_command, _, rest = string.partition(" ")
         # Commands are case-insensitive, stored as lowercase
         possible_command = possible_command.lower()
         if possible_command not in self.commands:
             return None, None
+        return possible_command, rest
 
-        event = self.commands[possible_command]["event"]
-        args = shlex.split(rest.strip())
-        return event, args
+    def parse_command(self, string):
+        """Parse out any possible valid command from an input string."""
+        possible_command, rest = self.find_command(string)
+        if possible_command is None:
+            return None, None
+        return self.parse_args(possible_command, rest)
+
+    def parse_args(self, possible_command, rest):
+        """Split a command's arguments; returns its event and the args."""
+        command = self.commands[possible_command]
+        style = command["args"]
+        if style == "raw":
+            rest = rest.strip()
+            args = [rest] if rest else []
+        elif style == "split":
+            args = rest.split()
+        else:
+            try:
+                args = split_args(rest)
+            except ValueError:
+                _log.debug("Ignoring '%s' invocation with bad quoting.",
+                           possible_command)
+                return None, None
+        return command["event"], args
 
     @Module.handle("NICK")
     def nick(self, client, old_nick, new_nick):
@@ -114,15 +528,38 @@ class CommandsModule(Module):
             self.regenerate_prefixes()
 
     @Module.handle("ADDCOMMAND")
-    def add_command(self, client, command, event, helptext=None):
+    def add_command(self, client, command, event, helptext=None,
+                    options=None):
         command = command.lower()
         if command in self.commands:
             _log.warning("Not adding command '%s' - already added.", command)
             return
+        options = options or {}
+        style = options.get("args", "shell")
+        if style not in ("shell", "split", "raw"):
+            _log.warning("Unknown argument style '%s' for command '%s'; "
+                         "using 'shell'.", style, command)
+            style = "shell"
+        if options.get("limit"):
+            try:
+                self.command_limits[command] = RateLimiter.from_string(
+                    options["limit"])
+            except ValueError:
+                _log.error("Ignoring invalid limit for command '%s'.",
+                           command)
+        deferred = bool(options.get("deferred"))
+        cache = float(options.get("cache") or 0)
+        if deferred and cache:
+            _log.warning("Not caching deferred command '%s'.", command)
+            cache = 0
         _log.info("Adding command '%s' => '%s'.", command, event)
         self.commands[command] = {
             "event": event,
             "help": helptext,
+            "args": style,
+            "cache": cache,
+            "deferred": deferred,
+            "timeout": options.get("timeout"),
         }
 
     @Module.handle("REMOVECOMMAND")
@@ -133,6 +570,8 @@ class CommandsModule(Module):
             if event == linked_event:
                 _log.info("Removing command '%s' => '%s'.", command, event)
                 del self.commands[command]
+                self.command_limits.pop(command, None)
+                self.invalidate_command(client, command)
             else:
                 _log.warning("Not removing command '%s' ('%s' != '%s').",
                              command, event, linked_event)
@@ -145,12 +584,140 @@ class CommandsModule(Module):
         if not parsable:
             return False
 
-        event, args = self.parse_command(rest)
+        command, rest = self.find_command(rest)
+        if command is None:
+            return False
+
+        # Rate limits are checked before anything else is done with the
+        # invocation, so that flooding a command costs as little as possible.
+        if not self.check_limits(client, actor, recipient, command):
+            return False
+
+        event, args = self.parse_args(command, rest)
         if not event:
             return False
 
+        if self.commands[command]["deferred"]:
+            return self.invoke_deferred(client, command, event, actor,
+                                        recipient, args)
+
+        ttl = self.commands[command]["cache"]
+        if not ttl:
+            _log.debug("Dispatching event '%s' (command invocation).", event)
+            return self.trigger_event(event, client, [actor, recipient] + args)
+
+        channel = recipient.name if isinstance(recipient, Channel) else None
+        key = (command, tuple(args), channel)
+        now = time.time()
+        entry = self.cache.pop(key, None)
+        if entry is not None and entry[0] > now:
+            _log.debug("Replaying cached response to '%s'.", command)
+            self.cache[key] = entry # Most recently used now
+            self.replay(client, entry[1], actor, recipient)
+            return
+
         _log.debug("Dispatching event '%s' (command invocation).", event)
-        return self.trigger_event(event, client, [actor, recipient] + args)
+        recorder = RecordingClient(client)
+        result = self.trigger_event(event, recorder,
+                                    [actor, recipient] + args)
+        # Only responses which actually said something are worth keeping
+        if recorder.calls:
+            self.cache[key] = (now + ttl, (actor, recipient, recorder.calls))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def invoke_deferred(self, client, command, event, actor, recipient, args):
+        invocation = Invocation(self, client, command, actor, recipient, args)
+        timeout = self.commands[command]["timeout"]
+        if timeout is not None:
+            invocation.timeout = float(timeout)
+        _log.debug("Dispatching event '%s' (deferred command invocation).",
+                   event)
+        try:
+            self.trigger_event(event, client, [invocation] + args)
+        finally:
+            if not invocation.pending:
+                # Finish behind anything the handler posted, so that its
+                # replies aren't dropped.
+                client.post(invocation._finish)
+        return True
+
+    def replay(self, client, recorded, actor, recipient):
+        """Repeat a recorded response to a new invocation.
+
+        Wherever the original invoker (or their nick) was passed to the
+        client, the new one is substituted.
+        """
+        old_actor, old_recipient, calls = recorded
+        old_nick = split_hostmask(str(old_actor))[0]
+        new_nick = split_hostmask(str(actor))[0]
+        substitutions = {
+            str(old_actor): actor,
+            old_nick: new_nick,
+            str(old_recipient): recipient,
+        }
+
+        def substitute(arg):
+            if not isinstance(arg, (basestring, User)):
+                return arg
+            replacement = substitutions.get(str(arg))
+            if replacement is None:
+                return arg
+            if isinstance(arg, User) and not isinstance(replacement, User):
+                return User(str(replacement))
+            return replacement
+
+        for name, args, kwargs in calls:
+            getattr(client, name)(*[substitute(arg) for arg in args],
+                                  **kwargs)
+
+    @Module.handle("INVALIDATECOMMAND")
+    def invalidate_command(self, client, command, args=None):
+        """Drop cached responses for a command (or one set of its args)."""
+        command = command.lower()
+        if args is not None:
+            args = tuple(args)
+        for key in self.cache.keys():
+            if key[0] == command and (args is None or key[1] == args):
+                del self.cache[key]
+
+    def check_limits(self, client, actor, recipient, command):
+        """Check (and if allowed, count) an invocation against the limits.
+
+        Returns False if the invocation is over any of them.
+        """
+        limits = []
+        nick, _, host = split_hostmask(str(actor))
+        user_key = (host or nick).lower()
+        if self.user_limit:
+            limits.append((self.user_limit, user_key))
+        if self.channel_limit and isinstance(recipient, Channel):
+            limits.append((self.channel_limit, recipient.name))
+        command_limit = self.command_limits.get(command, self.command_limit)
+        if command_limit:
+            limits.append((command_limit, command))
+        if not limits:
+            return True
+
+        now = time.time()
+        for limiter, key in limits:
+            if not limiter.allows(key, now):
+                _log.debug("Rate limiting '%s' from %s (%s limit).",
+                           command, actor, key)
+                self.notify_limited(client, actor, user_key, now)
+                return False
+        for limiter, key in limits:
+            limiter.take(key, now)
+        return True
+
+    def notify_limited(self, client, actor, user_key, now):
+        """Tell a user they're being rate limited, at most once a minute."""
+        if not self.limit_notice or not self.notice_limit.allows(user_key, now):
+            return
+        self.notice_limit.take(user_key, now)
+        nick = split_hostmask(str(actor))[0]
+        client.notice(nick, "Slow down! Try again in a little while.")
 
 
 module = CommandsModule
@@ -1,163 +1,694 @@
+import bisect
+import calendar
 import datetime
+import heapq
+import json
 import logging
+import os
 import random
+import select
 import threading
 import time
 
+try:
+    import pytz
+except ImportError:
+    pytz = None # Only local time and UTC are available
+
 from kitnirc.modular import Module
 
 
 _log = logging.getLogger(__name__)
 
 
+MONTH_NAMES = dict((name.lower(), index) for index, name
+                   in enumerate(calendar.month_abbr) if name)
+# Cron numbers weekdays from Sunday = 0 (7 is also accepted for Sunday).
+WEEKDAY_NAMES = dict((name.lower(), (index + 1) % 7) for index, name
+                     in enumerate(calendar.day_abbr))
+
+# How far ahead to look for a matching day before deciding that a cron
+# can never fire (e.g. February 30th).
+MAX_SEARCH_DAYS = 366 * 8
+
+# Seconds to wait after a change before saving the state file, so that a
+# burst of changes results in a single write.
+SAVE_DELAY = 5
+
+
+def get_timezone(name):
+    """Look up a timezone for use by Cron.
+
+    Returns None for local time, "UTC" for UTC, or a pytz timezone for any
+    other name (which requires pytz to be installed).
+    """
+    if not name or name.lower() == "local":
+        return None
+    if name.upper() == "UTC":
+        return "UTC"
+    if pytz is None:
+        raise ValueError("Timezone '%s' requires pytz, which is not "
+                         "installed." % name)
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        raise ValueError("Unknown timezone '%s'." % name)
+
+
+def wall_time(timestamp, tz):
+    """Convert a Unix timestamp to a naive datetime in the given timezone."""
+    if tz is None:
+        wall = datetime.datetime.fromtimestamp(timestamp)
+    elif tz == "UTC":
+        wall = datetime.datetime.utcfromtimestamp(timestamp)
+    else:
+        wall = datetime.datetime.fromtimestamp(timestamp, tz)
+    return wall.replace(tzinfo=None, microsecond=0)
+
+
+def timestamp(wall, tz):
+    """Convert a naive datetime in the given timezone to a Unix timestamp.
+
+    Wall times that occur twice when clocks go back resolve to the first
+    occurrence; times skipped when clocks go forward resolve to the
+    equivalent time after the change.
+    """
+    if tz is None:
+        # timetuple() of a naive datetime leaves DST for mktime to work out
+        return time.mktime(wall.timetuple())
+    if tz == "UTC":
+        return calendar.timegm(wall.timetuple())
+    aware = tz.normalize(tz.localize(wall, is_dst=True))
+    return calendar.timegm(aware.utctimetuple())
+
+
 class Cron(object):
-    """An individual cron entry."""
+    """An individual cron entry.
+
+    Fields follow the usual cron meanings: seconds, minutes and hours,
+    then day of the month (1-31), month (1-12 or jan-dec), and day of the
+    week (0-7 or sun-sat, with both 0 and 7 meaning Sunday). As in cron, if
+    both the day of month and day of week are restricted, a day matching
+    either one will do.
+
+    Times are matched against the wall clock of 'timezone' - local time if
+    not specified - and next_fire is a Unix timestamp, so changes to and
+    from daylight saving time neither skip nor repeat fires.
+
+    'values', if given, holds the already-parsed field values (as produced
+    by to_state()), and the field strings are then only kept for comparison.
+    This is how a cron with random ("?") fields keeps its offsets when it
+    is restored.
+    """
 
-    def __init__(self, event, seconds, minutes, hours):
+    def __init__(self, event, seconds="*", minutes="*", hours="*", days="*",
+                 months="*", weekdays="*", timezone=None, values=None):
         self.event = event
-        self.seconds = self.parse_time_field(seconds, 60)
-        self.minutes = self.parse_time_field(minutes, 60)
-        self.hours = self.parse_time_field(hours, 24)
-        now = datetime.datetime.now().replace(microsecond=0)
-        self.next_fire = self.calculate_next_fire(now)
+        self.spec = tuple(str(field) for field in
+                          (seconds, minutes, hours, days, months, weekdays))
+        self.timezone = timezone
+        self.tz = get_timezone(timezone)
+        if values is None:
+            values = [
+                self.parse_time_field(seconds, 0, 59),
+                self.parse_time_field(minutes, 0, 59),
+                self.parse_time_field(hours, 0, 23),
+                self.parse_time_field(days, 1, 31),
+                self.parse_time_field(months, 1, 12, MONTH_NAMES),
+                sorted(set(day % 7 for day in
+                    self.parse_time_field(weekdays, 0, 7, WEEKDAY_NAMES))),
+            ]
+        (self.seconds, self.minutes, self.hours,
+         self.days, self.months, self.weekdays) = [sorted(v) for v in values]
+        self.any_day = days.strip() == "*"
+        self.any_weekday = weekdays.strip() == "*"
+        self.coalesce = True
+        # Fires due before this time (i.e. missed while the bot was down)
+        # are delivered as one, even when catching up.
+        self.merge_before = 0
+        self.cancelled = False
+        self.next_fire = None
+        if not all([self.seconds, self.minutes, self.hours, self.days,
+                    self.months, self.weekdays]):
+            _log.warning("Cron '%s' has an empty field and will never fire.",
+                         event)
+            return
+        self.next_fire = self.calculate_next_fire(time.time())
 
-    def parse_time_field(self, inputstr, count):
+    def parse_time_field(self, inputstr, first, last, names=None):
         values = set()
 
+        def parse_value(value):
+            if names and value.lower() in names:
+                return names[value.lower()]
+            return int(value)
+
         for item in inputstr.split(","):
-            # See if it's just a single number.
+            item = item.strip()
+            item, _, divisor = item.partition("/")
+
             try:
-                values.add(int(item))
-                continue
-            except ValueError:
-                pass
-
-            # ? can be used to specify "a single random value"
-            if item.startswith('?'):
-                # With an optional /X to specify "every Xth value,
-                # offset randomly"
-                _, _, divisor = item.partition("/")
-                if divisor:
-                    divisor = int(divisor)
-                    offset = random.randint(0, divisor-1)
-                    values.update(range(offset, count, divisor))
-                else:
-                    values.add(random.randint(0, count-1))
-                continue
-
-            # * can be used to specify "all values"
-            if item.startswith("*"):
-                # With an optional /X to specify "every Xth value"
-                _, _, divisor = item.partition("/")
-                if divisor:
-                    values.update(range(0, count, int(divisor)))
+                divisor = int(divisor) if divisor else None
+
+                # ? can be used to specify "a single random value"
+                if item == "?":
+                    # With an optional /X to specify "every Xth value,
+                    # offset randomly"
+                    if divisor:
+                        offset = random.randint(0, divisor-1)
+                        values.update(range(first + offset, last + 1, divisor))
+                    else:
+                        values.add(random.randint(first, last))
+                    continue
+
+                # * can be used to specify "all values", and A-B a range of
+                # them, each with an optional /X for "every Xth value"
+                if item == "*":
+                    start, end = first, last
+                elif "-" in item:
+                    start, _, end = item.partition("-")
+                    start, end = parse_value(start), parse_value(end)
+                elif divisor is None:
+                    values.add(parse_value(item))
+                    continue
                 else:
-                    values.update(range(count))
-                continue
-
-            _log.warning("Ignoring invalid specifier '%s' for cron event '%s'",
-                item, self.event)
+                    raise ValueError(item)
+                values.update(range(start, end + 1, divisor or 1))
+            except ValueError:
+                _log.warning("Ignoring invalid specifier '%s' for cron event "
+                             "'%s'", item, self.event)
 
         # Ensure only values within the proper range are utilized
-        return sorted(val for val in values if 0 <= val < count)
-
+        return sorted(val for val in values if first <= val <= last)
+
+    def day_matches(self, day):
+        if not _contains(self.months, day.month):
+            return False
+        in_days = _contains(self.days, day.day)
+        in_weekdays = _contains(self.weekdays, (day.weekday() + 1) % 7)
+        if self.any_day:
+            return in_weekdays
+        if self.any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def next_time_of_day(self, hour, minute, second):
+        """The first matching (hour, minute, second) after the given one.
+
+        Each field is searched with a binary search, so this is logarithmic
+        in the number of values per field. Returns None if there are no
+        more matching times on the same day.
+        """
+        if _contains(self.hours, hour) and _contains(self.minutes, minute):
+            next_second = _next_value(self.seconds, second)
+            if next_second is not None:
+                return hour, minute, next_second
+
+        if _contains(self.hours, hour):
+            next_minute = _next_value(self.minutes, minute)
+            if next_minute is not None:
+                return hour, next_minute, self.seconds[0]
+
+        next_hour = _next_value(self.hours, hour)
+        if next_hour is not None:
+            return next_hour, self.minutes[0], self.seconds[0]
+
+        return None
+
+    def next_match(self, after):
+        """The first naive datetime strictly after 'after' that matches."""
+        day = after.date()
+        if self.day_matches(day):
+            next_time = self.next_time_of_day(after.hour, after.minute,
+                                              after.second)
+            if next_time is not None:
+                return datetime.datetime.combine(day,
+                                                 datetime.time(*next_time))
+
+        for _ in xrange(MAX_SEARCH_DAYS):
+            day += datetime.timedelta(days=1)
+            if self.day_matches(day):
+                return datetime.datetime.combine(day, datetime.time(
+                    self.hours[0], self.minutes[0], self.seconds[0]))
+        return None
 
     def calculate_next_fire(self, after):
-        # Keeps track of if we've already moved a field by at least
-        # one notch, so that other fields are allowed to stay the same.
-        equal_okay = False
-
-        next_second = self.seconds[0]
-        for second in self.seconds:
-            if second > after.second:
-                next_second = second
-                equal_okay = True
-                break
+        """Find the first Unix timestamp strictly after 'after' that matches.
 
-        next_minute = self.minutes[0]
-        for minute in self.minutes:
-            if equal_okay and minute == after.minute:
-                next_minute = minute
-                break
-            elif minute > after.minute:
-                next_minute = minute
-                equal_okay = True
-                break
+        Returns None if the cron can never fire again.
+        """
+        wall = wall_time(after, self.tz)
+        while True:
+            wall = self.next_match(wall)
+            if wall is None:
+                _log.warning("Cron '%s' will never fire again.", self.event)
+                return None
+            # When clocks go back, a wall time can map to a moment we've
+            # already passed; keep looking if so.
+            fire_time = timestamp(wall, self.tz)
+            if fire_time > after:
+                return fire_time
+
+    def fire(self, client):
+        """Hand this cron's event to the client loop, and work out when
+        the cron fires next.
+
+        If self.coalesce is set, a fire is dropped when the previous one is
+        still waiting for the client loop, and times missed while the cron
+        thread was running late are skipped. Otherwise every fire is
+        delivered, catching up on missed ones - except for those due before
+        self.merge_before, which are delivered as a single fire.
+        """
+        _log.debug("Cron event '%s' firing.", self.event)
+        key = ("cron", self.event) if self.coalesce else None
+        if not client.post(client.dispatch_event, (self.event,), key=key):
+            _log.debug("Cron event '%s' coalesced with a pending fire.",
+                       self.event)
+        after = self.next_fire
+        if self.coalesce or after < self.merge_before:
+            after = max(after, time.time())
+        self.next_fire = self.calculate_next_fire(after)
+
+    def to_state(self):
+        """A JSON-friendly description of this cron, for saving."""
+        return {
+            "spec": list(self.spec),
+            "timezone": self.timezone,
+            "values": [self.seconds, self.minutes, self.hours,
+                       self.days, self.months, self.weekdays],
+            "next_fire": self.next_fire,
+        }
+
+    @classmethod
+    def from_state(cls, event, state):
+        """Recreate a cron saved with to_state().
+
+        next_fire is recalculated from the current time; the saved value is
+        left to the caller.
+        """
+        spec = [str(field) for field in state["spec"]]
+        timezone = state.get("timezone")
+        if timezone is not None:
+            timezone = str(timezone)
+        return cls(str(event), *spec, timezone=timezone,
+                   values=state["values"])
 
-        next_hour = self.hours[0]
-        for hour in self.hours:
-            if equal_okay and hour == after.hour:
-                next_hour = hour
-                break
-            elif hour > after.hour:
-                next_hour = hour
-                break
 
-        next_fire = after.replace(hour=next_hour, minute=next_minute,
-                                second=next_second, microsecond=0)
+class Timer(object):
+    """A one-shot delayed event.
 
-        # If we need to roll over to the next day...
-        if next_fire <= after:
-            next_fire += datetime.timedelta(days=1)
+    Timers are identified by a handle, which defaults to the event name.
+    """
 
-        return next_fire
+    def __init__(self, event, delay, handle=None, args=()):
+        self.event = event
+        self.handle = handle or event
+        self.args = tuple(args)
+        self.cancelled = False
+        self.next_fire = time.time() + float(delay)
+
+    def fire(self, client):
+        _log.debug("Timer '%s' firing event '%s'.", self.handle, self.event)
+        client.post_event(self.event, *self.args)
+        self.next_fire = None
 
-    def maybe_fire(self, client, after, upto):
-        if self.next_fire is None:
-            return
-        if after < self.next_fire <= upto:
-            _log.debug("Cron event '%s' firing.", self.event)
-            client.dispatch_event(self.event)
-            self.next_fire = self.calculate_next_fire(upto)
+
+def _contains(values, value):
+    """Whether a sorted list contains a value."""
+    index = bisect.bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+def _next_value(values, value):
+    """The first item of a sorted list greater than value, or None."""
+    index = bisect.bisect_right(values, value)
+    if index < len(values):
+        return values[index]
+    return None
 
 
 class CronModule(Module):
     """A KitnIRC module which provides other modules with scheduling.
 
-    Note: due to how this module interacts with other modules, reloading
-    it without reloading other modules will result in previously added
-    crons being wiped. If you need to reload this module, you should
-    probably just reload all modules.
+    Two kinds of schedule are supported: crons, which fire an event
+    repeatedly at times matching a cron-style specification, and timers,
+    which fire an event once after a delay (with sub-second precision).
+    Timers save modules from having to run their own sleeper threads to
+    "do X in 30 seconds".
+
+    Crons are matched against local time unless a timezone is given,
+    either per cron or as the default in the config:
+
+    [cron]
+    timezone = UTC
+    missed = coalesce
+    state_file = cron.json
+
+    (Timezones other than local time and UTC require pytz.)
+
+    Events are not dispatched from the cron thread itself, but handed to
+    the client's run() loop (see Client.post()), so handlers never run
+    concurrently with each other. The 'missed' setting decides what
+    happens when a cron comes due while its previous fire is still
+    waiting for a busy loop: with "coalesce" (the default), the fires are
+    merged into one, and fire times missed entirely are skipped; with
+    "catchup", every fire is delivered, late if need be.
+
+    Everything is kept in a min-heap ordered by fire time. The cron
+    thread sleeps until exactly the earliest of those times (or until a new
+    entry is added ahead of it), fires whatever is due, and pushes each
+    fired cron back onto the heap at its following fire time. Adding an
+    entry is O(log n); removing one marks it as cancelled, and cancelled
+    entries are discarded as they reach the top of the heap (or all at
+    once, if they come to outnumber the live ones).
+
+    Registered crons, along with their resolved field values and next fire
+    times, are saved to 'state_file' (relative paths are taken relative to
+    the config file; the default is cron.json next to it, and an empty
+    value turns saving off). The file is written a few seconds after any
+    change and when the module stops, and read back when it starts, so
+    crons survive both reloading this module and restarting the bot, and
+    "?" fields keep the offsets they were first given. A restored cron
+    whose fire time passed while the bot was down is treated according to
+    the 'missed' setting: skipped to its next time with "coalesce", or
+    fired straight away (once, however many times were missed) with
+    "catchup". A module which re-sends ADDCRON for a restored cron with the
+    same spec leaves it as it is; a different spec replaces it. Restored
+    crons which no module has re-sent by the end of STARTUP are dropped,
+    since the module that added them is presumably gone. Timers are not
+    saved, since their arguments can be arbitrary objects.
+
+    When only this module is reloaded, its crons and timers are handed
+    straight over to the new instance (see export_state()), whether or
+    not a state file is used.
+
+    Incoming events:
+      ADDCRON       event [seconds [minutes [hours [days [months [weekdays
+                    [timezone]]]]]]]
+      REMOVECRON    event
+      ADDTIMER      event delay [handle [args]]
+      CANCELTIMER   handle
     """
 
     def __init__(self, *args, **kwargs):
         super(CronModule, self).__init__(*args, **kwargs)
-        self.crons = []
-        self.last_tick = datetime.datetime.now()
-        self.thread = threading.Thread(target=self.loop, name='cron')
-        self.thread.daemon = True
+        config = self.controller.config
+        if config and config.has_option("cron", "timezone"):
+            self.timezone = config.get("cron", "timezone")
+        else:
+            self.timezone = None
+        if config and config.has_option("cron", "missed"):
+            self.coalesce = config.get("cron", "missed") != "catchup"
+        else:
+            self.coalesce = True
+        self.state_file = self.get_state_file(config)
+
+        self.crons = {} # event -> Cron
+        self.restored = set() # crons loaded from state_file, not re-added
+        self.state_imported = False # handed over by a reload, not loaded
+        self.dirty_since = None # when unsaved changes were first made
+        self.timers = {} # handle -> Timer
+        self.heap = [] # (fire time, sequence, Cron or Timer)
+        self.cancelled = 0 # number of dead entries in the heap
+        self.sequence = 0 # tie-breaker for entries with equal times
+        self.lock = threading.Lock()
+        # Writing to this pipe wakes up the cron thread early. It and the
+        # thread are created in start(), so that the module can be started
+        # again after being stopped.
+        self._wake_r = self._wake_w = None
+        self._wake_closed = True
+        self.thread = None
         self._stop = False
 
+    def get_state_file(self, config):
+        path = "cron.json"
+        if config and config.has_option("cron", "state_file"):
+            path = config.get("cron", "state_file").strip()
+        if not path:
+            return None
+        config_path = self.controller.config_path
+        if not os.path.isabs(path):
+            if config_path is None:
+                return None
+            path = os.path.join(os.path.dirname(config_path), path)
+        return path
+
     def start(self, *args, **kwargs):
         super(CronModule, self).start(*args, **kwargs)
+        if not self.state_imported:
+            self.load_state()
         self._stop = False
-        self.last_tick = datetime.datetime.now()
+        with self.lock:
+            self._wake_r, self._wake_w = os.pipe()
+            self._wake_closed = False
+        self.thread = threading.Thread(target=self.loop, name='cron')
+        self.thread.daemon = True
         self.thread.start()
 
     def stop(self, *args, **kwargs):
         super(CronModule, self).stop(*args, **kwargs)
         self._stop = True
-        # In any normal circumstances, the cron thread should finish in
-        # about half a second or less. We'll give it a little extra buffer.
+        if self.thread is None:
+            return # Never started
+        self.wake()
         self.thread.join(1.0)
         if self.thread.is_alive():
             _log.warning("Cron thread alive 1s after shutdown request.")
+        else:
+            # Under the lock, so that nothing is partway through wake()
+            with self.lock:
+                self._wake_closed = True
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+        self.save_state()
+
+    def load_state(self):
+        """Restore the crons saved in the state file, if there is one."""
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            _log.exception("Couldn't read cron state from %s.",
+                           self.state_file)
+            return
+
+        now = time.time()
+        with self.lock:
+            for event, entry in state.get("crons", {}).iteritems():
+                try:
+                    cron = Cron.from_state(event, entry)
+                except (ValueError, KeyError, TypeError) as e:
+                    _log.error("Not restoring cron '%s': %s", event, e)
+                    continue
+                cron.coalesce = self.coalesce
+                saved_fire = entry.get("next_fire")
+                if saved_fire is None:
+                    cron.next_fire = None
+                elif saved_fire > now or not self.coalesce:
+                    cron.next_fire = saved_fire
+                    cron.merge_before = now
+                old = self.crons.get(cron.event)
+                if old is not None:
+                    self.cancel(old)
+                self.crons[cron.event] = cron
+                self.restored.add(cron.event)
+                self.schedule(cron)
+        _log.info("Restored %d cron(s) from %s.", len(self.restored),
+                  self.state_file)
+
+    def export_state(self):
+        with self.lock:
+            timers = [(timer.event, timer.handle, timer.args, timer.next_fire)
+                      for timer in self.timers.itervalues()
+                      if not timer.cancelled]
+            return {
+                "crons": dict((event, cron.to_state())
+                              for event, cron in self.crons.iteritems()),
+                "restored": set(self.restored),
+                "timers": timers,
+            }
+
+    def import_state(self, state):
+        with self.lock:
+            for event, entry in state["crons"].iteritems():
+                cron = Cron.from_state(event, entry)
+                cron.coalesce = self.coalesce
+                cron.next_fire = entry.get("next_fire")
+                self.crons[event] = cron
+                self.schedule(cron)
+            self.restored = set(state["restored"])
+            for event, handle, args, next_fire in state["timers"]:
+                timer = Timer(event, 0, handle, args)
+                timer.next_fire = next_fire
+                self.timers[timer.handle] = timer
+                self.schedule(timer)
+        self.state_imported = True
+
+    @Module.handle("STARTUP")
+    def startup(self, client, *args):
+        # Modules re-send ADDCRON for the crons they want while starting up,
+        # so once everything has handled STARTUP, any restored cron nobody
+        # has claimed can go.
+        if self.restored:
+            client.post(self.drop_unclaimed)
+
+    def drop_unclaimed(self):
+        """Remove restored crons which no module has re-added."""
+        with self.lock:
+            for event in self.restored:
+                cron = self.crons.pop(event, None)
+                if cron is not None:
+                    _log.info("Dropping restored cron '%s' - no module "
+                              "added it again.", event)
+                    self.cancel(cron)
+            if self.restored:
+                self.mark_dirty()
+            self.restored = set()
+
+    def save_state(self):
+        """Write the registered crons to the state file, if there is one."""
+        if self.state_file is None:
+            return
+        with self.lock:
+            state = {"crons": dict((event, cron.to_state())
+                                   for event, cron in self.crons.iteritems())}
+            self.dirty_since = None
+        # Write to a temporary file first, so that a crash can't leave a
+        # half-written state file behind.
+        temp_path = self.state_file + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+            os.rename(temp_path, self.state_file)
+        except (IOError, OSError):
+            _log.exception("Couldn't save cron state to %s.", self.state_file)
+
+    def mark_dirty(self):
+        """Note that the state file needs updating.
+
+        Must be called with self.lock held.
+        """
+        if self.state_file is None or self.dirty_since is not None:
+            return
+        self.dirty_since = time.time()
+        self.wake()
+
+    def wake(self):
+        """Interrupt the cron thread's sleep.
+
+        Does nothing once the module has been stopped (events such as
+        ADDCRON can still arrive afterwards).
+        """
+        if not self._wake_closed:
+            os.write(self._wake_w, "x")
+
+    def schedule(self, entry):
+        """Push a cron or timer onto the heap at its next fire time.
+
+        Must be called with self.lock held. Returns True if the entry is now
+        the earliest one (and so the cron thread needs waking up).
+        """
+        if entry.next_fire is None:
+            return False
+        self.sequence += 1
+        item = (entry.next_fire, self.sequence, entry)
+        heapq.heappush(self.heap, item)
+        return self.heap[0] is item
+
+    def cancel(self, entry):
+        """Mark a cron or timer as cancelled.
+
+        Must be called with self.lock held. The heap entry is left in place
+        and skipped when it comes up, unless dead entries have come to
+        outnumber the live ones.
+        """
+        entry.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [item for item in self.heap if not item[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def pop_due(self, now):
+        """Pop every live entry that is due at 'now' off of the heap.
+
+        Must be called with self.lock held.
+        """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self.heap)
+            if entry.cancelled:
+                self.cancelled = max(self.cancelled - 1, 0)
+            else:
+                due.append(entry)
+        return due
+
+    def next_timeout(self, now):
+        """Seconds until the earliest entry is due, or None if none are.
+
+        Must be called with self.lock held.
+        """
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled = max(self.cancelled - 1, 0)
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - now, 0)
 
     def loop(self):
         while not self._stop:
-            # Use a single "now" for all crons, to ensure consistency
-            # relative to the next last_tick value.
-            now = datetime.datetime.now().replace(microsecond=0)
+            now = time.time()
+            with self.lock:
+                due = self.pop_due(now)
+
+            for entry in due:
+                try:
+                    entry.fire(self.controller.client)
+                except Exception:
+                    _log.exception("Error firing '%s'.", entry.event)
+                with self.lock:
+                    if isinstance(entry, Timer):
+                        if self.timers.get(entry.handle) is entry:
+                            del self.timers[entry.handle]
+                    elif not entry.cancelled:
+                        self.schedule(entry)
+                        # Saved fire times only matter when catching up
+                        if not self.coalesce:
+                            self.mark_dirty()
+
+            with self.lock:
+                now = time.time()
+                save_due = (self.dirty_since is not None and
+                            now - self.dirty_since >= SAVE_DELAY)
+            if save_due:
+                self.save_state()
+
+            with self.lock:
+                now = time.time()
+                timeout = self.next_timeout(now)
+                if self.dirty_since is not None:
+                    save_in = max(self.dirty_since + SAVE_DELAY - now, 0)
+                    if timeout is None or save_in < timeout:
+                        timeout = save_in
+            if self._stop:
+                break
+            readable, _, _ = select.select([self._wake_r], [], [], timeout)
+            if readable:
+                os.read(self._wake_r, 4096)
 
-            for cron in self.crons:
-                cron.maybe_fire(self.controller.client, self.last_tick, now)
+    def add_entry(self, entry):
+        """Schedule a new entry, waking the cron thread if needed.
 
-            self.last_tick = now
-            # Wake up every half-second or so to avoid missing seconds
-            time.sleep(0.5)
+        Must be called with self.lock held.
+        """
+        if self.schedule(entry):
+            self.wake()
 
     @Module.handle("ADDCRON")
-    def add_cron(self, client, event, seconds="*", minutes="*", hours="*"):
+    def add_cron(self, client, event, seconds="*", minutes="*", hours="*",
+                 days="*", months="*", weekdays="*", timezone=None):
         """Add a cron entry.
 
         The arguments for this event are:
@@ -165,6 +696,11 @@ class CronModule(Module):
             2. What seconds to trigger on, as a timespec (default "*")
             3. What minutes to trigger on, as a timespec (default "*")
             4. What hours to trigger on, as a timespec (default "*")
+            5. What days of the month to trigger on (default "*")
+            6. What months to trigger on (default "*")
+            7. What days of the week to trigger on (default "*")
+            8. The timezone to interpret all of the above in (defaults to
+               the [cron] timezone setting, or else local time)
 
         Timespecs may be omitted in reverse order of frequency - if hours
         is omitted, the previous timespecs will be applied every hour. If
@@ -175,6 +711,9 @@ class CronModule(Module):
         Timespecs are strings in the following formats:
 
             Plain integer - specifies that exact value for the unit.
+            Name  - for months and days of the week, e.g. "jan" or "mon".
+            "A-B" - specifies all values from A to B, inclusive.
+            "A-B/X" - specifies every Xth value from A to B.
             "?"   - specifies a random value from 0 to the unit max.
             "?/X" - specifies all multiples of X for this unit, randomly offset
                     by a fixed amount (e.g. ?/15 might become 4,19,34,49).
@@ -183,28 +722,84 @@ class CronModule(Module):
 
         Any number of these can be combined in a comma-separated list.
         For instance, "*/15" would be the same as "0,15,30,45" if used
-        in the seconds field.
+        in the seconds field, and "mon-fri" in the days of the week field
+        restricts a cron to weekdays.
         """
-        for cron in self.crons:
-            if cron.event == event:
-                _log.warning("Cron '%s' is already registered.", event)
-                return True
+        with self.lock:
+            timezone = timezone or self.timezone
+            restored = event in self.restored
+            self.restored.discard(event)
+            if event in self.crons:
+                old = self.crons[event]
+                if not restored:
+                    _log.warning("Cron '%s' is already registered.", event)
+                    return True
+                spec = tuple(str(field) for field in
+                             (seconds, minutes, hours, days, months,
+                              weekdays))
+                if old.spec == spec and old.timezone == timezone:
+                    _log.debug("Keeping restored cron for '%s'.", event)
+                    return True
+                _log.info("Replacing restored cron for '%s'.", event)
+                self.cancel(old)
+                del self.crons[event]
 
-        _log.info("Registering cron for '%s'.", event)
-        cron = Cron(event, seconds, minutes, hours)
-        self.crons.append(cron)
+            try:
+                cron = Cron(event, seconds, minutes, hours, days, months,
+                            weekdays, timezone)
+            except ValueError as e:
+                _log.error("Not registering cron for '%s': %s", event, e)
+                return True
+            _log.info("Registering cron for '%s'.", event)
+            cron.coalesce = self.coalesce
+            self.crons[event] = cron
+            self.add_entry(cron)
+            self.mark_dirty()
         return True
 
     @Module.handle("REMOVECRON")
     def remove_cron(self, client, event):
         """Remove a cron entry by event name."""
-        for index, cron in enumerate(self.crons):
-            if cron.event == event:
+        with self.lock:
+            cron = self.crons.pop(event, None)
+            self.restored.discard(event)
+            if cron is not None:
                 _log.info("De-registering cron '%s'.", event)
-                # Yes, we're modifying the list we're iterating over, but
-                # we immediate stop iterating so it's okay.
-                self.crons.pop(index)
-                break
+                self.cancel(cron)
+                self.mark_dirty()
+        return True
+
+    @Module.handle("ADDTIMER")
+    def add_timer(self, client, event, delay, handle=None, args=()):
+        """Add a one-shot timer.
+
+        The arguments for this event are:
+            1. The name of the event to dispatch when the timer fires.
+            2. How many seconds from now it should fire (may be fractional).
+            3. A handle for the timer, which can be passed to CANCELTIMER
+               (defaults to the event name).
+            4. A list of arguments to dispatch the event with.
+
+        Adding a timer with the same handle as an existing one replaces it.
+        """
+        with self.lock:
+            timer = Timer(event, delay, handle, args)
+            old = self.timers.get(timer.handle)
+            if old is not None:
+                _log.debug("Replacing timer '%s'.", timer.handle)
+                self.cancel(old)
+            self.timers[timer.handle] = timer
+            self.add_entry(timer)
+        return True
+
+    @Module.handle("CANCELTIMER")
+    def cancel_timer(self, client, handle):
+        """Cancel a timer by handle, if it hasn't fired yet."""
+        with self.lock:
+            timer = self.timers.pop(handle, None)
+            if timer is not None:
+                _log.debug("Cancelling timer '%s'.", handle)
+                self.cancel(timer)
         return True
 
 
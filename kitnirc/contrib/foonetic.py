@@ -23,13 +23,16 @@ class FooneticModule(Module):
 
     @Module.handle("PASSWORD")
     def nickserv_password(self, client, *args):
+        if client.sasl:
+            # Already authenticating via SASL during registration.
+            return
         # Foonetic will pass through the server password to NickServ,
         # skipping the need to send a password via PRIVMSG.
         if self.controller.config.has_option("nickserv", "password"):
-            # Sending directly via the socket, to avoid logging
+            # send_secret() keeps the password out of the logs
             password = self.controller.config.get("nickserv", "password")
             _log.info("Sending NickServ password...")
-            client.socket.send("PASS %s\r\n" % password)
+            client.send_secret("PASS", password)
 
 
 module = FooneticModule
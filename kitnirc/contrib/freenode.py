@@ -26,15 +26,18 @@ class FreenodeModule(Module):
 
     @Module.handle("PASSWORD")
     def nickserv_password(self, client, *args):
+        if client.sasl:
+            # Already authenticating via SASL during registration.
+            return
         # Freenode will pass through the server password to NickServ,
         # skipping the need to send a password via PRIVMSG. If the bot
         # has an account under a different name than its nick, you can
         # use accountnick:password as the value of the password field.
         if self.controller.config.has_option("nickserv", "password"):
-            # Sending directly via the socket, to avoid logging
+            # send_secret() keeps the password out of the logs
             password = self.controller.config.get("nickserv", "password")
             _log.info("Sending NickServ password...")
-            client.socket.send("PASS %s\r\n" % password)
+            client.send_secret("PASS", password)
 
 
 module = FreenodeModule
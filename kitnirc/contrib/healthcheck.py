@@ -1,3 +1,6 @@
+import bisect
+import collections
+import itertools
 import logging
 import os
 import threading
@@ -9,42 +12,146 @@ from kitnirc.modular import Module
 _log = logging.getLogger(__name__)
 
 
+# Upper bounds (in seconds) of the lag histogram's buckets
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class LagHistogram(object):
+    """A histogram of the most recent lag samples.
+
+    Only the last 'size' samples are counted; as new samples come in, the
+    oldest ones drop out. Each bucket counts the samples no greater than its
+    bound (and greater than the previous one), with a final bucket for
+    anything above the largest bound.
+    """
+
+    def __init__(self, size=100, buckets=LAG_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.samples = collections.deque(maxlen=size)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, sample):
+        if len(self.samples) == self.samples.maxlen:
+            old = self.samples[0]
+            self.counts[bisect.bisect_left(self.buckets, old)] -= 1
+            self.total -= old
+        self.samples.append(sample)
+        self.counts[bisect.bisect_left(self.buckets, sample)] += 1
+        self.total += sample
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    @property
+    def mean(self):
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+    def percentile(self, percent):
+        """The sample below which 'percent'% of the samples fall."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = int(round((len(ordered) - 1) * percent / 100.0))
+        return ordered[index]
+
+    def items(self):
+        """A list of (upper bound, count) pairs, the last bound being None."""
+        return zip(self.buckets + (None,), self.counts)
+
+
 class HealthcheckModule(Module):
     """A KitnIRC module which checks connection health.
 
-    By default, this module will request a PONG response from the server
-    if it hasn't seen any traffic in the past minute, and will assume the
-    connection has dropped and exit the process if it doesn't see any traffic
-    for 90 seconds.
+    The connection is probed with PINGs carrying a unique token, and the
+    time until the matching PONG comes back is recorded as the lag. The
+    most recent measurement is kept in client.lag, and a rolling histogram
+    of recent ones in this module's .lag_histogram.
+
+    Probes are sent every 'interval' seconds (30 by default). While other
+    traffic is flowing, the connection is evidently alive, so the interval
+    doubles after each probe (up to 'max_interval', 300 by default); it
+    drops back once the connection goes quiet. Regardless of the interval,
+    the server is probed if no traffic has been seen for 'delay' seconds
+    (60 by default), and if none has been seen for 'timeout' seconds (90
+    by default), the connection is assumed to have dropped and the process
+    exits.
+
+    If the lag (or the age of an unanswered probe) exceeds 'shed_lag'
+    seconds, the client starts shedding load: commands listed in 'shed'
+    (by default NOTICE, WHO, WHOIS, WHOWAS, LIST and NAMES) are dropped
+    instead of being sent, until the lag falls back below half of that.
 
-    These delays can be changed by setting "delay" and "timeout" under the
-    [healthcheck] configuration section.
+    All of these can be changed under the [healthcheck] configuration
+    section:
+
+    [healthcheck]
+    delay = 60
+    timeout = 90
+    interval = 30
+    max_interval = 300
+    shed_lag = 5
+    shed = NOTICE WHO WHOIS WHOWAS LIST NAMES
+    ; Number of lag samples kept for the histogram
+    samples = 100
+
+    Outgoing events:
+      LAG           lag shedding
+
+    The LAG event fires whenever a probe is answered. The histogram is
+    kept when the module is reloaded.
     """
 
     def __init__(self, *args, **kwargs):
         super(HealthcheckModule, self).__init__(*args, **kwargs)
         config = self.controller.config
 
-        if config.has_option("healthcheck", "delay"):
-            self.delay = config.getint("healthcheck", "delay")
-        else:
-            self.delay = 60
+        def get_option(name, default):
+            if config.has_option("healthcheck", name):
+                return config.getfloat("healthcheck", name)
+            return default
 
-        if config.has_option("healthcheck", "timeout"):
-            self.timeout = config.getint("healthcheck", "timeout")
+        self.delay = int(get_option("delay", 60))
+        self.timeout = int(get_option("timeout", 90))
+        self.interval = get_option("interval", 30.0)
+        self.max_interval = get_option("max_interval", 300.0)
+        self.shed_lag = get_option("shed_lag", 5.0)
+        if config.has_option("healthcheck", "shed"):
+            self.shed = set(config.get("healthcheck", "shed").upper().split())
         else:
-            self.timeout = 90
+            self.shed = None # Leave the client's default
+        self.previous_shed = None # What the client had before start()
 
         assert self.timeout > self.delay
 
+        self.lag_histogram = LagHistogram(int(get_option("samples", 100)))
+        self.probe_interval = self.interval
+        self.probes = {} # token -> time sent
+        self.last_probe = 0
+        self._tokens = itertools.count(1)
+        self.lock = threading.Lock()
+
         self.last_activity = time.time()
         self._stop = False
-        self.thread = threading.Thread(target=self.loop, name='healthcheck')
-        self.thread.daemon = True
+        self.thread = None
 
     def start(self, *args, **kwargs):
         super(HealthcheckModule, self).start(*args, **kwargs)
+        if self.shed is not None:
+            client = self.controller.client
+            self.previous_shed = client.sheddable
+            client.sheddable = self.shed
         self._stop = False
+        # A new thread each time, so that the module can be started again
+        # after being stopped (as happens when a reload is rolled back).
+        self.thread = threading.Thread(target=self.loop, name='healthcheck')
+        self.thread.daemon = True
         self.thread.start()
 
     def stop(self, *args, **kwargs):
@@ -52,15 +159,43 @@ class HealthcheckModule(Module):
         self._stop = True
         # In any normal circumstances, the healthcheck thread should finish
         # in about a second or less. We'll give it a little extra buffer.
-        self.thread.join(2.0)
-        if self.thread.is_alive():
-            _log.warning("Healthcheck thread alive 2s after shutdown request.")
+        if self.thread is not None:
+            self.thread.join(2.0)
+            if self.thread.is_alive():
+                _log.warning("Healthcheck thread alive 2s after shutdown "
+                             "request.")
+        client = self.controller.client
+        client.shedding = False
+        if self.previous_shed is not None:
+            client.sheddable = self.previous_shed
+            self.previous_shed = None
+
+    def export_state(self):
+        return {
+            "lag_histogram": self.lag_histogram,
+            "probe_interval": self.probe_interval,
+            "last_activity": self.last_activity,
+        }
+
+    def import_state(self, state):
+        # Samples carry over even if the configured number has changed
+        histogram = LagHistogram(self.lag_histogram.samples.maxlen,
+                                 self.lag_histogram.buckets)
+        if state.get("lag_histogram") is not None:
+            for sample in state["lag_histogram"].samples:
+                histogram.add(sample)
+        self.lag_histogram = histogram
+        self.probe_interval = min(state.get("probe_interval", self.interval),
+                                  self.max_interval)
+        self.last_activity = state.get("last_activity", self.last_activity)
 
     def loop(self):
         _log.info("Healthcheck running: delay=%d timeout=%d",
                   self.delay, self.timeout)
+        client = self.controller.client
         while not self._stop:
-            elapsed = time.time() - self.last_activity
+            now = time.time()
+            elapsed = now - self.last_activity
 
             if elapsed > self.timeout:
                 _log.fatal("No incoming in last %d seconds - exiting.", elapsed)
@@ -68,16 +203,96 @@ class HealthcheckModule(Module):
                 # We use this instead of sys.exit because the latter just raises
                 # SystemExit in this thread, causing the thread to shut down.
                 os._exit(os.EX_IOERR)
-            elif elapsed > self.delay:
-                _log.debug("Sending healthcheck ping...")
-                self.controller.client.ping()
+
+            with self.lock:
+                # A probe still unanswered after the timeout was lost, not
+                # delayed, so it says nothing about the lag any more.
+                self.expire_probes(now)
+                oldest = min(self.probes.itervalues()) if self.probes else None
+                since_probe = now - self.last_probe
+
+            if elapsed > self.delay or (oldest is None and
+                                        since_probe >= self.probe_interval):
+                client.post(self.probe, key="healthcheck")
+
+            # An unanswered probe puts a lower bound on the current lag
+            lag = client.lag or 0
+            if oldest is not None:
+                lag = max(lag, now - oldest)
+            if lag > self.shed_lag and not client.shedding:
+                client.post(self.set_shedding, (True, lag),
+                            key="healthcheck-shedding")
+            elif lag < self.shed_lag / 2 and client.shedding:
+                client.post(self.set_shedding, (False, lag),
+                            key="healthcheck-shedding")
 
             time.sleep(1)
 
+    def probe(self):
+        """Send a PING with a fresh token, and note when it was sent."""
+        client = self.controller.client
+        if not client.connected:
+            return
+        token = "kitnirc-%d" % next(self._tokens)
+        now = time.time()
+        with self.lock:
+            self.expire_probes(now)
+            self.probes[token] = now
+            self.last_probe = now
+        _log.debug("Sending healthcheck ping %s...", token)
+        client.ping(token)
+
+    def expire_probes(self, now):
+        """Forget probes that can no longer be answered in time to matter.
+
+        Must be called with .lock held.
+        """
+        for token, sent in self.probes.items():
+            if now - sent > self.timeout:
+                del self.probes[token]
+
+    def set_shedding(self, shedding, lag):
+        client = self.controller.client
+        if shedding == client.shedding:
+            return
+        client.shedding = shedding
+        if shedding:
+            _log.warning("Lag is %.1fs; shedding non-essential traffic.", lag)
+        else:
+            _log.info("Lag is back down to %.1fs; no longer shedding "
+                      "(%d line(s) dropped so far).", lag, client.shed_count)
+
     @Module.handle("ACTIVITY")
     def activity(self, client):
         self.last_activity = time.time()
 
+    @Module.handle("PONG")
+    def pong(self, client, actor, token):
+        now = time.time()
+        with self.lock:
+            sent = self.probes.pop(token, None)
+            if sent is None:
+                return # Not one of ours
+            # Any older probes must have been lost
+            for old_token, old_sent in self.probes.items():
+                if old_sent < sent:
+                    del self.probes[old_token]
+
+        lag = now - sent
+        client.lag = lag
+        self.lag_histogram.add(lag)
+
+        # If anything else arrived while we waited, the connection is busy
+        # enough that we needn't probe it as often.
+        if self.last_activity > sent:
+            self.probe_interval = min(self.probe_interval * 2,
+                                      self.max_interval)
+        else:
+            self.probe_interval = self.interval
+        _log.debug("Lag %.3fs; next probe in %ds.", lag, self.probe_interval)
+
+        self.trigger_event("LAG", client, [lag, client.shedding])
+
 
 module = HealthcheckModule
 
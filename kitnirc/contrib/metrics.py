@@ -0,0 +1,287 @@
+import BaseHTTPServer
+import logging
+import os
+import SocketServer
+import threading
+import time
+
+from kitnirc.modular import Module
+
+
+_log = logging.getLogger(__name__)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the current metrics on GET /metrics (or /)."""
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.module.render()
+        except Exception:
+            _log.exception("Error rendering metrics.")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The default implementation writes to stderr, and chokes on the
+        # client address of Unix socket connections.
+        _log.debug("Metrics request: " + format, *args)
+
+
+class MetricsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixMetricsHTTPServer(SocketServer.ThreadingMixIn,
+                            SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+class MetricsModule(Module):
+    """A KitnIRC module which exports metrics for monitoring.
+
+    Metrics are served over HTTP in the Prometheus text format, on a port
+    bound to localhost or on a Unix socket:
+
+    [metrics]
+    port = 9105
+    ; Or, instead of a port:
+    ;socket = /var/run/mybot/metrics.sock
+    ; The address to bind to when using a port
+    ;host = 127.0.0.1
+
+    Everything exported is read from counters which the client and the
+    controller keep anyway, at the time of the request, so nothing extra
+    happens as lines and events go by. Counters are totals; rates (e.g.
+    lines per second) are left to whatever does the scraping.
+
+    The following metrics are exported:
+      kitnirc_lines_received_total      lines read from the server
+      kitnirc_lines_sent_total          lines written to the server
+      kitnirc_lines_shed_total          lines dropped while shedding load
+      kitnirc_outbound_queue            lines waiting to be written
+                                        (see Client.send_queued())
+      kitnirc_connected                 1 if connected, else 0
+      kitnirc_connects_total            successful connects
+      kitnirc_reconnects_total          connects after the first one
+      kitnirc_channels                  channels currently joined
+      kitnirc_channel_members           members across those channels
+      kitnirc_lag_seconds               the most recent PING round trip
+      kitnirc_lag_histogram_seconds     recent PING round trips (needs
+                                        the healthcheck module)
+      kitnirc_module_reloads_total      module reloads
+      kitnirc_modules                   modules currently loaded
+      kitnirc_modules_lazy              lazy modules not loaded yet
+      kitnirc_module_lazy_load_seconds  how long each lazy module took
+                                        to load
+      kitnirc_module_startup_seconds    how long each module took to load,
+                                        warm up and start
+      kitnirc_module_handler_seconds    time spent in each module's
+                                        handlers (count and sum)
+      kitnirc_module_handler_overruns_total
+                                        handler calls over budget
+      kitnirc_event_dispatch_seconds    time spent dispatching each event
+                                        to modules (count and sum)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MetricsModule, self).__init__(*args, **kwargs)
+        config = self.controller.config
+
+        self.socket_path = None
+        self.address = None
+        if config.has_option("metrics", "socket"):
+            self.socket_path = config.get("metrics", "socket")
+        else:
+            host = "127.0.0.1"
+            if config.has_option("metrics", "host"):
+                host = config.get("metrics", "host")
+            port = 9105
+            if config.has_option("metrics", "port"):
+                port = config.getint("metrics", "port")
+            self.address = (host, port)
+
+        self.server = None
+        self.thread = None
+        self.started = time.time()
+
+    def start(self, *args, **kwargs):
+        super(MetricsModule, self).start(*args, **kwargs)
+        try:
+            if self.socket_path:
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path) # Left over from a crash
+                self.server = UnixMetricsHTTPServer(self.socket_path,
+                                                    MetricsHandler)
+                where = self.socket_path
+            else:
+                self.server = MetricsHTTPServer(self.address, MetricsHandler)
+                where = "%s:%d" % self.address
+        except (OSError, IOError) as e:
+            _log.error("Unable to serve metrics: %s", e)
+            self.server = None
+            return
+        self.server.module = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        _log.info("Serving metrics on %s.", where)
+
+    def stop(self, *args, **kwargs):
+        super(MetricsModule, self).stop(*args, **kwargs)
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(1.0)
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = None
+
+    def render(self):
+        """Build the text of the metrics page.
+
+        This runs on the server's thread, so it only takes snapshots of the
+        client's and controller's state (copying lists of dict values is
+        atomic) rather than iterating over anything that might change.
+        """
+        client = self.controller.client
+        controller = self.controller
+        lines = []
+
+        def metric(name, kind, help, value, labels=None):
+            if kind is not None:
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, kind))
+            if labels:
+                name = "%s{%s}" % (name, ",".join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in labels))
+            if isinstance(value, (int, long)):
+                lines.append("%s %d" % (name, value))
+            else:
+                lines.append("%s %r" % (name, float(value)))
+
+        metric("kitnirc_lines_received_total", "counter",
+               "Lines read from the server.", client.lines_in)
+        metric("kitnirc_lines_sent_total", "counter",
+               "Lines written to the server.", client.lines_out)
+        metric("kitnirc_lines_shed_total", "counter",
+               "Lines dropped while shedding load.", client.shed_count)
+        transport = client.transport
+        metric("kitnirc_outbound_queue", "gauge",
+               "Lines waiting to be written, including rate-limited ones.",
+               client.queued +
+               (transport.pending if transport is not None else 0))
+        metric("kitnirc_connected", "gauge",
+               "Whether the client is connected.", int(client.connected))
+        metric("kitnirc_connects_total", "counter",
+               "Successful connects.", client.connect_count)
+        metric("kitnirc_reconnects_total", "counter",
+               "Connects after the first one.",
+               max(client.connect_count - 1, 0))
+
+        channels = []
+        if client.server is not None:
+            channels = client.server.channels.values()
+        metric("kitnirc_channels", "gauge",
+               "Channels currently joined.", len(channels))
+        metric("kitnirc_channel_members", "gauge",
+               "Members across all joined channels.",
+               sum(len(channel.members) for channel in channels))
+
+        if client.lag is not None:
+            metric("kitnirc_lag_seconds", "gauge",
+                   "The most recent PING round trip.", client.lag)
+        self.render_lag_histogram(metric)
+
+        metric("kitnirc_module_reloads_total", "counter",
+               "Module reloads.", controller.reload_count)
+        metric("kitnirc_modules", "gauge",
+               "Modules currently loaded.", len(controller.loaded_modules))
+        metric("kitnirc_modules_lazy", "gauge",
+               "Lazy modules not loaded yet.", len(controller.lazy_modules))
+        kind = "gauge"
+        for module_name, elapsed in sorted(controller.lazy_load_times.items()):
+            metric("kitnirc_module_lazy_load_seconds", kind,
+                   "Time taken to load each lazily loaded module.", elapsed,
+                   [("module", module_name)])
+            kind = None
+
+        kind = "gauge"
+        for module_name, times in sorted(controller.startup_times.items()):
+            for phase, elapsed in sorted(times.items()):
+                metric("kitnirc_module_startup_seconds", kind,
+                       "Time taken by each phase of starting each module.",
+                       elapsed, [("module", module_name), ("phase", phase)])
+                kind = None
+
+        name = "kitnirc_module_handler_seconds"
+        lines.append("# HELP %s Time spent in each module's event handlers."
+                     % name)
+        lines.append("# TYPE %s summary" % name)
+        handler_stats = sorted(controller.handler_stats.items())
+        for module_name, (count, total, _) in handler_stats:
+            metric(name + "_count", None, None, count,
+                   [("module", module_name)])
+            metric(name + "_sum", None, None, total, [("module", module_name)])
+        kind = "counter"
+        for module_name, (_, _, overruns) in handler_stats:
+            metric("kitnirc_module_handler_overruns_total", kind,
+                   "Handler calls which went over the module's budget.",
+                   overruns, [("module", module_name)])
+            kind = None
+
+        name = "kitnirc_event_dispatch_seconds"
+        lines.append("# HELP %s Time spent dispatching events to modules."
+                     % name)
+        lines.append("# TYPE %s summary" % name)
+        for event, (count, total) in sorted(controller.event_stats.items()):
+            metric(name + "_count", None, None, count, [("event", event)])
+            metric(name + "_sum", None, None, total, [("event", event)])
+
+        metric("kitnirc_metrics_uptime_seconds", "gauge",
+               "Seconds since the metrics module started.",
+               time.time() - self.started)
+
+        return "\n".join(lines) + "\n"
+
+    def render_lag_histogram(self, metric):
+        """Export the healthcheck module's lag histogram, if it's loaded."""
+        histogram = None
+        for module in self.controller.loaded_modules.values():
+            histogram = getattr(module, "lag_histogram", None)
+            if histogram is not None:
+                break
+        if histogram is None or not len(histogram):
+            return
+
+        name = "kitnirc_lag_histogram_seconds"
+        kind, help = "histogram", "Recent PING round trips."
+        cumulative = 0
+        for bound, count in histogram.items():
+            cumulative += count
+            le = "+Inf" if bound is None else repr(bound)
+            metric(name + "_bucket", kind, help, cumulative, [("le", le)])
+            kind = None
+        metric(name + "_count", None, None, len(histogram))
+        metric(name + "_sum", None, None, histogram.total)
+
+
+module = MetricsModule
+
+# vim: set ts=4 sts=4 sw=4 et:
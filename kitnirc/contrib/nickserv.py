@@ -12,6 +12,9 @@ class NickServModule(Module):
     using the password found in the nickserv section.
     [nickserv]
     ;password = <password>
+
+    If the client already logged in to an account via SASL while
+    connecting, no IDENTIFY is sent.
     """
     
     @Module.handle("WELCOME")
@@ -19,6 +22,10 @@ class NickServModule(Module):
 
         config = self.controller.config
 
+        if client.account:
+            _log.info("Already identified as '%s' via SASL.", client.account)
+            return
+
         if config.has_option("nickserv", "password"):
             _log.info("Identifiying with NickServ.")
             password = config.get("nickserv", "password")
@@ -0,0 +1,336 @@
+import logging
+import re
+import urlparse
+
+from kitnirc.modular import Module
+
+
+_log = logging.getLogger(__name__)
+
+
+# Python's re module refuses patterns with more than 100 groups, so regex
+# triggers are combined into chunks of at most this many groups each.
+MAX_GROUPS = 99
+
+# Words, for keyword triggers
+_WORD_RE = re.compile(r"\w+", re.U)
+# Anything that looks like a link, for URL triggers
+_URL_RE = re.compile(r"\b(?:https?://|www\.)[^\s<>\"']+", re.I)
+# Things that stop a pattern being combined with others: inline flags
+# (which would apply to the whole combined pattern), numbered
+# backreferences and conditional group references (whose numbers would
+# change) and named groups (whose names might clash).
+_UNCOMBINABLE_RE = re.compile(r"\(\?[iLmsux]+\)|\\[1-9]|\(\?P|\(\?\(")
+
+
+class RegexChunk(object):
+    """Up to MAX_GROUPS groups' worth of regex triggers, compiled as one.
+
+    Each trigger's pattern becomes a named alternative of the combined
+    pattern, so a single search finds whichever of them matches first.
+    The combined pattern is only compiled when it's next needed.
+    """
+
+    def __init__(self, flags, exclusive=False):
+        self.flags = flags
+        self.exclusive = exclusive # Not to be combined with anything else
+        self.triggers = [] # (name, compiled pattern), in registration order
+        self.groups = 0
+        self.compiled = None
+
+    def fits(self, pattern):
+        return (not self.exclusive and pattern.flags == self.flags and
+                self.groups + pattern.groups + 1 <= MAX_GROUPS)
+
+    def add(self, name, pattern):
+        self.triggers.append((name, pattern))
+        self.groups += pattern.groups + 1
+        self.compiled = None
+
+    def remove(self, name):
+        for i, (other, pattern) in enumerate(self.triggers):
+            if other == name:
+                del self.triggers[i]
+                self.groups -= pattern.groups + 1
+                self.compiled = None
+                return True
+        return False
+
+    def compile(self):
+        if self.exclusive:
+            # A chunk of one, left exactly as it is
+            name, pattern = self.triggers[0]
+            self.by_group = {None: (name, pattern)}
+            self.compiled = pattern
+            return
+        # Each alternative ends with an empty named group, which closes
+        # after any groups inside it, so a match's lastgroup says which one
+        # matched. Marking the end rather than wrapping the whole pattern
+        # leaves the alternatives' first characters visible to the regex
+        # compiler, which can then skip quickly to places where one of them
+        # might match.
+        self.by_group = {}
+        alternatives = []
+        for i, (name, pattern) in enumerate(self.triggers):
+            group = "t%d" % i
+            self.by_group[group] = (name, pattern)
+            regex = pattern.pattern
+            if "|" in regex:
+                regex = "(?:%s)" % regex
+            alternatives.append("%s(?P<%s>)" % (regex, group))
+        self.compiled = re.compile("|".join(alternatives), self.flags)
+
+    def search(self, message, found):
+        """Add (name, match) for each trigger which matches the message.
+
+        Every position in the message is considered, so overlapping matches
+        are found. The combined pattern only says which trigger matched
+        first at a position, so the others are then tried there one by one.
+        """
+        if not self.triggers:
+            return
+        if self.compiled is None:
+            self.compile()
+        remaining = len(self.triggers)
+        pos = 0
+        while pos <= len(message):
+            match = self.compiled.search(message, pos)
+            if match is None:
+                return
+            start = match.start()
+            name, pattern = self.by_group[
+                None if self.exclusive else match.lastgroup]
+            if name not in found:
+                first = pattern.match(message, start)
+                if first is not None:
+                    found[name] = first
+                    remaining -= 1
+            if remaining and not self.exclusive:
+                for name, pattern in self.triggers:
+                    if name in found:
+                        continue
+                    other = pattern.match(message, start)
+                    if other is not None:
+                        found[name] = other
+                        remaining -= 1
+            if not remaining:
+                return
+            pos = start + 1
+
+
+class TriggersModule(Module):
+    """A KitnIRC module which matches messages against many patterns at once.
+
+    Rather than every module scanning every message for whatever it's
+    interested in, modules register triggers via the ADDTRIGGER event
+    (and remove them when they shut down via the REMOVETRIGGER event).
+    All of the registered triggers are checked in one pass over each
+    message, and only the events of triggers that matched are triggered.
+
+    Each trigger has a name, the event to trigger and a pattern, and can
+    be given a dictionary of options. The "type" option says what kind
+    of pattern it is:
+      "keyword"   a word or phrase, matched case-insensitively as whole
+                  words (the default)
+      "regex"     a regular expression, searched for anywhere in the
+                  message; the "flags" option can give re flags for it
+      "url"       a domain (matching links to it or its subdomains), or
+                  "*" for any link
+
+    The "channels" option (a list) limits a trigger to messages in those
+    channels; by default, messages in all channels and in PMs count.
+
+    Triggered events are passed the actor, the recipient, the message
+    and what matched: the keyword, the regex's match object, or the link.
+    Each trigger fires at most once per message.
+
+    Keywords and domains are looked up in dictionaries, for the words and
+    links found in the message. Regexes are combined, a chunk at a time,
+    into larger patterns which are searched once per message; adding or
+    removing a regex only recompiles the chunk it's in, the next time a
+    message is checked.
+
+    As with COMMANDS, this module triggers the TRIGGERS event if it needs
+    other modules to (re-)register their triggers.
+
+    Incoming events:
+      ADDTRIGGER    name event pattern [options]
+      REMOVETRIGGER name event
+
+    Outgoing events:
+      TRIGGERS      n/a
+      *             actor recipient message match
+    """
+
+    provides = ("triggers",)
+
+    def __init__(self, *args, **kwargs):
+        super(TriggersModule, self).__init__(*args, **kwargs)
+        self.triggers = {}
+
+    def start(self, *args, **kwargs):
+        super(TriggersModule, self).start(*args, **kwargs)
+        self.triggers = {} # name -> trigger info
+        self.keywords = {} # first word -> {name: [words]}
+        self.domains = {} # domain -> set of names
+        self.chunks = [] # RegexChunks
+        self.request_triggers(self.controller.client)
+
+    @Module.handle("STARTUP")
+    def request_triggers(self, client, *args):
+        self.trigger_event("TRIGGERS", client, [])
+
+    @Module.handle("ADDTRIGGER")
+    def add_trigger(self, client, name, event, pattern, options=None):
+        if name in self.triggers:
+            _log.warning("Not adding trigger '%s' - already added.", name)
+            return
+        options = options or {}
+        kind = options.get("type", "keyword")
+        channels = options.get("channels")
+        if channels is not None:
+            channels = set(str(channel).lower() for channel in channels)
+        trigger = {
+            "event": event,
+            "type": kind,
+            "pattern": pattern,
+            "channels": channels,
+        }
+
+        if kind == "keyword":
+            words = [word.lower() for word in _WORD_RE.findall(pattern)]
+            if not words:
+                _log.error("Not adding trigger '%s' - no words in keyword.",
+                           name)
+                return
+            self.keywords.setdefault(words[0], {})[name] = words
+        elif kind == "url":
+            domain = pattern.lower().lstrip(".")
+            self.domains.setdefault(domain, set()).add(name)
+        elif kind == "regex":
+            flags = options.get("flags", 0)
+            try:
+                compiled = re.compile(pattern, flags)
+            except re.error as e:
+                _log.error("Not adding trigger '%s' - bad regex: %s", name, e)
+                return
+            trigger["chunk"] = self.chunk_for(compiled)
+            trigger["chunk"].add(name, compiled)
+        else:
+            _log.error("Not adding trigger '%s' - unknown type '%s'.",
+                       name, kind)
+            return
+
+        _log.info("Adding %s trigger '%s' => '%s'.", kind, name, event)
+        self.triggers[name] = trigger
+
+    def chunk_for(self, compiled):
+        """Find (or make) a chunk which a new regex can be added to."""
+        exclusive = bool(_UNCOMBINABLE_RE.search(compiled.pattern) or
+                         compiled.groups + 1 > MAX_GROUPS)
+        if not exclusive:
+            for chunk in self.chunks:
+                if chunk.fits(compiled):
+                    return chunk
+        chunk = RegexChunk(compiled.flags, exclusive)
+        self.chunks.append(chunk)
+        return chunk
+
+    @Module.handle("REMOVETRIGGER")
+    def remove_trigger(self, client, name, event):
+        trigger = self.triggers.get(name)
+        if trigger is None:
+            _log.warning("Not removing trigger '%s' - not added.", name)
+            return
+        if trigger["event"] != event:
+            _log.warning("Not removing trigger '%s' ('%s' != '%s').",
+                         name, event, trigger["event"])
+            return
+
+        _log.info("Removing trigger '%s' => '%s'.", name, event)
+        del self.triggers[name]
+        kind = trigger["type"]
+        if kind == "keyword":
+            first = _WORD_RE.findall(trigger["pattern"])[0].lower()
+            names = self.keywords[first]
+            del names[name]
+            if not names:
+                del self.keywords[first]
+        elif kind == "url":
+            domain = trigger["pattern"].lower().lstrip(".")
+            names = self.domains[domain]
+            names.discard(name)
+            if not names:
+                del self.domains[domain]
+        else:
+            chunk = trigger["chunk"]
+            chunk.remove(name)
+            if not chunk.triggers:
+                self.chunks.remove(chunk)
+
+    def match(self, message):
+        """Find the triggers matching a message.
+
+        Returns a dictionary of trigger name -> what matched.
+        """
+        found = {}
+
+        if self.keywords:
+            words = [word.lower() for word in _WORD_RE.findall(message)]
+            for i, word in enumerate(words):
+                candidates = self.keywords.get(word)
+                if not candidates:
+                    continue
+                for name, keyword in candidates.iteritems():
+                    if name not in found and \
+                            words[i:i + len(keyword)] == keyword:
+                        found[name] = self.triggers[name]["pattern"]
+
+        if self.domains and ("." in message):
+            for url in _URL_RE.findall(message):
+                self.match_url(url, found)
+
+        for chunk in self.chunks:
+            chunk.search(message, found)
+
+        return found
+
+    def match_url(self, url, found):
+        if "://" not in url:
+            url = "http://" + url
+        host = (urlparse.urlsplit(url).hostname or "").rstrip(".")
+        names = set(self.domains.get("*", ()))
+        # The domain itself and each of its parents
+        parts = host.split(".")
+        for i in range(len(parts)):
+            names.update(self.domains.get(".".join(parts[i:]), ()))
+        for name in names:
+            if name not in found:
+                found[name] = url
+
+    @Module.handle("PRIVMSG")
+    def privmsg(self, client, actor, recipient, message):
+        if not self.triggers:
+            return
+        found = self.match(message)
+        if not found:
+            return
+
+        target = str(recipient).lower()
+        for name, matched in sorted(found.iteritems()):
+            trigger = self.triggers.get(name)
+            if trigger is None:
+                continue # Removed by an earlier trigger's handler
+            if trigger["channels"] is not None and \
+                    target not in trigger["channels"]:
+                continue
+            _log.debug("Dispatching event '%s' (trigger '%s').",
+                       trigger["event"], name)
+            self.trigger_event(trigger["event"], client,
+                               [actor, recipient, message, matched])
+
+
+module = TriggersModule
+
+
+# vim: set ts=4 sts=4 sw=4 et:
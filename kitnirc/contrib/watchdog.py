@@ -0,0 +1,96 @@
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from kitnirc.modular import Module
+
+
+_log = logging.getLogger(__name__)
+
+
+class WatchdogModule(Module):
+    """A KitnIRC module which reports event handlers that are running late.
+
+    The controller times every handler against the budgets in the [budgets]
+    config section (see Controller.read_budgets()), and unloads modules
+    which keep going over them - but it can only do that once a handler
+    has returned. This module watches from a separate thread, so that a
+    handler which is still running past its budget (perhaps stuck in a
+    loop) is noticed while it's happening: the stack of the thread it's
+    running on is sampled and logged, every 'interval' seconds until the
+    handler returns. The most recent samples are also kept in .samples.
+
+    [watchdog]
+    ; Seconds between checks (and between samples of a handler's stack)
+    interval = 1
+    ; Number of samples kept
+    samples = 50
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(WatchdogModule, self).__init__(*args, **kwargs)
+        config = self.controller.config
+
+        def get_option(name, default):
+            if config.has_option("watchdog", name):
+                return config.getfloat("watchdog", name)
+            return default
+
+        self.interval = get_option("interval", 1.0)
+        # (module, event, seconds running, formatted stack)
+        self.samples = collections.deque(maxlen=int(get_option("samples", 50)))
+
+        self._stop = False
+        self.thread = None
+
+    def start(self, *args, **kwargs):
+        super(WatchdogModule, self).start(*args, **kwargs)
+        if self.controller.default_budget is None and \
+                not self.controller.budgets:
+            _log.warning("No handler budgets are configured in [budgets]; "
+                         "the watchdog has nothing to check.")
+        self._stop = False
+        # A new thread each time, so that the module can be restarted
+        self.thread = threading.Thread(target=self.loop, name='watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, *args, **kwargs):
+        super(WatchdogModule, self).stop(*args, **kwargs)
+        self._stop = True
+        if self.thread is not None:
+            self.thread.join(self.interval + 1)
+
+    def loop(self):
+        controller = self.controller
+        while not self._stop:
+            time.sleep(self.interval)
+            # The innermost handler running; read once, since the loop
+            # thread may replace it at any moment.
+            current = controller.current_handler
+            if current is None:
+                continue
+            module_name, event, started, _, ident = current
+            budget = controller.budgets.get(module_name,
+                                            controller.default_budget)
+            running = time.time() - started
+            if not budget or running <= budget:
+                continue
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+            self.samples.append((module_name, event, running, stack))
+            _log.warning("Module '%s' has been handling '%s' for %.1fs "
+                         "(budget %.3fs), at:\n%s", module_name, event,
+                         running, budget, stack)
+
+
+module = WatchdogModule
+
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -162,6 +162,15 @@ NUMERIC_EVENTS = {
     "492": "NOSERVICEHOST",
     "501": "UMODEUNKNOWNFLAG",
     "502": "USERSDONTMATCH",
+    "900": "LOGGEDIN",     # IRCv3 SASL
+    "901": "LOGGEDOUT",
+    "902": "NICKLOCKED",
+    "903": "SASLSUCCESS",
+    "904": "SASLFAIL",
+    "905": "SASLTOOLONG",
+    "906": "SASLABORTED",
+    "907": "SASLALREADY",
+    "908": "SASLMECHS",
 }
 
 # vim: set ts=4 sts=4 sw=4 et:
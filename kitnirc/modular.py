@@ -1,7 +1,14 @@
 import ConfigParser
+import heapq
 import importlib
 import inspect
 import logging
+import collections
+import sys
+import thread
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 _log = logging.getLogger(__name__)
 
@@ -11,7 +18,17 @@ DEFAULT_SUBSTITUTIONS = {}
 
 
 class Module(object):
-    """A single module that can be loaded into a Controller."""
+    """A single module that can be loaded into a Controller.
+
+    Modules may list the names of things they provide (e.g. "commands"),
+    and of things they require, in .provides and .requires; every module
+    also provides its own name. Modules are started (and receive events)
+    after the modules providing what they require, and otherwise in order
+    of priority.
+    """
+
+    requires = ()
+    provides = ()
 
     def __init__(self, controller):
         self.controller = controller
@@ -62,6 +79,16 @@ class Module(object):
         for event in self.event_handlers:
             self.controller.listen(event)
 
+    def warm_up(self):
+        """Called after the module is loaded, before start().
+
+        This is the place for slow preparation which doesn't involve other
+        modules or the client, such as reading a large file: the warm_up()
+        of modules which don't depend on one another run concurrently, on
+        separate threads. If this raises, the module isn't started.
+        """
+        pass
+
     def stop(self, reloading=False):
         """Called when the module is loaded.
 
@@ -70,6 +97,26 @@ class Module(object):
         """
         pass
 
+    def export_state(self):
+        """Called before the module is reloaded, to save its state.
+
+        Whatever this returns (unless it's None) is passed to the new
+        instance's import_state(), so that in-memory state such as caches
+        can be carried over instead of rebuilt. It's called before stop().
+        By default, there is no state to carry over.
+        """
+        return None
+
+    def import_state(self, state):
+        """Called on a reloaded module with its predecessor's state.
+
+        This is called before start(reloading=True), with the result of the
+        old instance's export_state(). Since the old instance may be running
+        older code, the state may be in an older format. If this raises, the
+        reload is rolled back to the old instance.
+        """
+        pass
+
     def handle_event(self, event, client, args):
         """Dispatch an event to its handler.
 
@@ -106,8 +153,40 @@ class Controller(object):
         self.loaded_modules = {}
         self.module_ordering = []
 
+        # Modules configured to be loaded lazily which haven't been yet,
+        # mapped to the events which will load them; and, for each module
+        # that has been loaded lazily, how many seconds that took.
+        self.lazy_modules = {}
+        self.lazy_load_times = {}
+
+        # How many threads run modules' warm_up()s, and for each module,
+        # how long the phases of starting it up last took, in seconds:
+        # {"load": ..., "warm_up": ..., "start": ...}
+        self.startup_threads = 4
+        self.startup_times = {}
+        # Each module's dependencies: the modules providing what it requires
+        self.dependencies = {}
+        self.missing_requirements = {} # module -> what nothing provides
+
+        # Time budgets for modules' event handlers, from the [budgets]
+        # config section (see read_budgets()), and per module, [handler
+        # calls, total seconds, overruns]. The handler currently running
+        # is [module, event, start time, seconds spent in nested handlers,
+        # thread ident], or None.
+        self.default_budget = None
+        self.budgets = {}
+        self.max_strikes = 3
+        self.strike_window = 600
+        self.strikes = {} # module -> times of recent overruns
+        self.handler_stats = {}
+        self.current_handler = None
+        # Modules to unload once the current event has been dispatched
+        self.to_disable = set()
+        self.dispatch_depth = 0
+
         # What events we have registered to receive
         self.registered = set()
+        self.listen_lock = threading.Lock()
 
         self.DEFAULT_SUBSTITUTIONS = dict(DEFAULT_SUBSTITUTIONS)
 
@@ -120,6 +199,11 @@ class Controller(object):
         self.currently_loading = set()
         self.loaded_on_this_event = None
 
+        # Statistics, for monitoring: how many module reloads there have
+        # been, and per event, [times dispatched, total seconds spent].
+        self.reload_count = 0
+        self.event_stats = {}
+
     def listen(self, event):
         """Request that the Controller listen for and dispatch an event.
 
@@ -127,13 +211,14 @@ class Controller(object):
         unloaded, the Controller will continue to dispatch the event, there
         just might not be anything that cares about it. That's okay.
         """
-        if event in self.registered:
-            # Already listening to this event
-            return
-        def handler(client, *args):
-            return self.process_event(event, client, args)
-        self.client.add_handler(event, handler)
-        self.registered.add(event)
+        with self.listen_lock:
+            if event in self.registered:
+                # Already listening to this event
+                return
+            def handler(client, *args):
+                return self.process_event(event, client, args)
+            self.client.add_handler(event, handler)
+            self.registered.add(event)
         _log.debug("Controller is now listening for '%s' events", event)
 
     def start(self):
@@ -170,19 +255,200 @@ class Controller(object):
         old_loaded = self.loaded_on_this_event
         self.loaded_on_this_event = set(old_loaded or []) if not force_dispatch else set()
 
+        started = time.time()
+        self.dispatch_depth += 1
         try:
             _log.debug("Controller is dispatching '%s' event", event)
             for module_name in self.module_ordering:
-                if module_name in self.loaded_on_this_event and not force_dispatch:
+                if module_name in self.lazy_modules:
+                    # Not loaded yet; only an event it handles loads it, and
+                    # that event is dispatched to it straight away.
+                    if event not in self.lazy_modules[module_name]:
+                        continue
+                    if not self.load_lazy_module(module_name, event):
+                        continue
+                elif module_name in self.loaded_on_this_event and not force_dispatch:
                     _log.debug("Not dispatching %s to '%s' because it was just "
                                "loaded (%r).", event, module_name,
                                self.loaded_on_this_event)
                     continue
+                if module_name in self.to_disable:
+                    continue
                 module = self.loaded_modules[module_name]
-                if module.handle_event(event, client, args):
+                if event not in module.event_handlers and \
+                        type(module).handle_event == Module.handle_event:
+                    continue # Nothing to run, so nothing to time
+                if self.run_handler(module_name, module, event, client, args):
                     return True
         finally:
             self.loaded_on_this_event = old_loaded
+            stats = self.event_stats.get(event)
+            if stats is None:
+                stats = self.event_stats[event] = [0, 0.0]
+            stats[0] += 1
+            stats[1] += time.time() - started
+            self.dispatch_depth -= 1
+            if self.to_disable and not self.dispatch_depth:
+                self.disable_modules()
+
+    def run_handler(self, module_name, module, event, client, args):
+        """Have a module handle an event, timing it against its budget.
+
+        The time spent in handlers of events dispatched by the handler is
+        counted against those handlers' modules, not this one.
+        """
+        parent = self.current_handler
+        started = time.time()
+        current = [module_name, event, started, 0.0, thread.get_ident()]
+        self.current_handler = current
+        try:
+            return module.handle_event(event, client, args)
+        finally:
+            self.current_handler = parent
+            total = time.time() - started
+            if parent is not None:
+                parent[3] += total
+            elapsed = total - current[3]
+            stats = self.handler_stats.get(module_name)
+            if stats is None:
+                stats = self.handler_stats[module_name] = [0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            budget = self.budgets.get(module_name, self.default_budget)
+            if budget and elapsed > budget:
+                stats[2] += 1
+                self.handler_overran(module_name, event, elapsed, budget)
+
+    def handler_overran(self, module_name, event, elapsed, budget):
+        """Note a handler going over budget, and disable repeat offenders."""
+        _log.warning("Module '%s' took %.3fs to handle '%s' (budget %.3fs).",
+                     module_name, elapsed, event, budget)
+        if not self.max_strikes:
+            return
+        now = time.time()
+        strikes = self.strikes.get(module_name)
+        if strikes is None:
+            strikes = self.strikes[module_name] = collections.deque()
+        strikes.append(now)
+        while strikes and now - strikes[0] > self.strike_window:
+            strikes.popleft()
+        if len(strikes) >= self.max_strikes:
+            _log.error("Disabling module '%s': it went over its budget %d "
+                       "times in %ds.", module_name, len(strikes),
+                       self.strike_window)
+            self.to_disable.add(module_name)
+
+    def disable_modules(self):
+        """Unload the modules which have been disabled."""
+        to_disable, self.to_disable = self.to_disable, set()
+        for module_name in to_disable:
+            self.strikes.pop(module_name, None)
+            try:
+                self.unload_module(module_name)
+            except Exception:
+                _log.exception("Error unloading module '%s'.", module_name)
+                self.loaded_modules.pop(module_name, None)
+                if module_name in self.module_ordering:
+                    self.module_ordering.remove(module_name)
+
+    def read_budgets(self):
+        """Read handler time budgets from the [budgets] config section.
+
+        [budgets]
+        ; Seconds any one handler call may take, by default
+        default = 0.5
+        ; Seconds for particular modules
+        modules.slowpoke = 2
+        ; A module going over its budget this many times in 'window'
+        ; seconds is unloaded (0 to never unload)
+        strikes = 3
+        window = 600
+        """
+        self.default_budget = None
+        self.budgets = {}
+        self.max_strikes = 3
+        self.strike_window = 600
+        if not self.config.has_section("budgets"):
+            return
+        for name, value in self.config.items("budgets"):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                _log.error("Ignoring invalid [budgets] setting for '%s'.",
+                           name)
+                continue
+            if name == "default":
+                self.default_budget = value
+            elif name == "strikes":
+                self.max_strikes = int(value)
+            elif name == "window":
+                self.strike_window = value
+            else:
+                self.budgets[name] = value
+
+    def load_lazy_module(self, module_name, event):
+        """Load and start a lazy module, for the first event it handles.
+
+        Like the modules loaded at startup, the module is sent the STARTUP
+        event once it has started (unless that is the event loading it).
+
+        Returns True if the module was successfully loaded, otherwise False.
+        """
+        self.lazy_modules.pop(module_name, None)
+        started = time.time()
+        if not self.load_module(module_name):
+            _log.error("Failed to lazily load module '%s'.", module_name)
+            self.drop_lazy_module(module_name)
+            return False
+        module = self.loaded_modules[module_name]
+        try:
+            module.warm_up()
+        except Exception:
+            _log.exception("Failed to warm up module '%s'.", module_name)
+            self.drop_lazy_module(module_name)
+            return False
+        try:
+            module.start(reloading=False)
+        except Exception:
+            _log.exception("Failed to start module '%s'.", module_name)
+            self.drop_lazy_module(module_name)
+            return False
+        if event != "STARTUP":
+            try:
+                self.run_handler(module_name, module, "STARTUP",
+                                 self.client, ())
+            except Exception:
+                _log.exception("Module '%s' failed to handle STARTUP.",
+                               module_name)
+        elapsed = time.time() - started
+        self.lazy_load_times[module_name] = elapsed
+        _log.info("Lazily loaded module '%s' for '%s' event in %.3fs.",
+                  module_name, event, elapsed)
+        if event not in module.event_handlers:
+            _log.warning("Module '%s' was lazily loaded for '%s' events, "
+                         "but doesn't handle them.", module_name, event)
+        return True
+
+    def drop_lazy_module(self, module_name):
+        """Forget a lazy module which couldn't be loaded."""
+        self.loaded_modules.pop(module_name, None)
+        # Rebound rather than modified, since it's being iterated over
+        self.module_ordering = [name for name in self.module_ordering
+                                if name != module_name]
+
+    def lazy_config(self):
+        """Read the [lazy] config section: module name -> set of events."""
+        lazy = {}
+        if not self.config.has_section("lazy"):
+            return lazy
+        for module_name, events in self.config.items("lazy"):
+            events = set((events or "").split())
+            if not events:
+                _log.warning("Loading module '%s' normally - no events "
+                             "listed for it in [lazy].", module_name)
+                continue
+            lazy[module_name] = events
+        return lazy
 
     def initialize_config(self, config):
         """Writes default sections into the config."""
@@ -193,7 +459,13 @@ class Controller(object):
         config.add_section("modules")
 
     def load_config(self, config_path=None):
-        """Load configuration from the specified path, or self.config_path"""
+        """Load configuration from the specified path, or self.config_path
+
+        The first time configuration is loaded, all of the configured modules
+        are loaded. After that, only the changes to the [modules] section are
+        applied (see update_modules()); use reload_modules() to reload
+        everything.
+        """
         if config_path is None:
             config_path = self.config_path
         else:
@@ -211,8 +483,13 @@ class Controller(object):
             _log.exception("Ignoring config from %s due to error.", config_path)
             return False
 
+        old_config = self.config
         self.config = config
-        self.reload_modules()
+        self.read_budgets()
+        if old_config is None or not old_config.has_section("modules"):
+            self.reload_modules()
+        else:
+            self.update_modules(old_config)
         return True
 
     def save_config(self, config_path=None):
@@ -228,21 +505,34 @@ class Controller(object):
     def reload_modules(self):
         """(Re)load all of the configured modules.
 
-        1. Calls stop(reloading=True) on each loaded module
+        1. Calls export_state() and stop(reloading=True) on each loaded module
         2. Clears .loaded_modules and .module_ordering
-        3. Loads each module specified in the config
-        4. Calls start() on each loaded module, with reloading set depending
+        3. Loads each module specified in the config, except for those
+           listed in the [lazy] section, which are loaded when the first
+           of the events listed for them is dispatched
+        4. Orders the modules by their dependencies and priorities
+           (see order_modules()), holding back any which require a module
+           that failed to load (see held_back())
+        5. Calls import_state() with its exported state (if any) on each
+           loaded module, then warm_up() on all of them (concurrently, as
+           far as their dependencies allow)
+        6. Calls start() on each loaded module, with reloading set depending
            on whether the module was previously loaded or not
-        5. Dispatches the STARTUP event, since all modules have been rebooted
+        7. Dispatches the STARTUP event, since all modules have been rebooted
 
         Returns True if all modules reloaded successfully, otherwise False.
         """
+        self.reload_count += 1
         old_modules = set(self.loaded_modules)
-        for module in self.loaded_modules.itervalues():
+        states = {}
+        for module_name, module in self.loaded_modules.iteritems():
+            states[module_name] = self.export_module_state(module_name,
+                                                           module)
             module.stop(reloading=True)
 
         self.loaded_modules = {}
         self.module_ordering = []
+        self.lazy_modules = {}
 
         try:
             modules_to_load = sorted(self.config.items("modules"),
@@ -253,54 +543,479 @@ class Controller(object):
 
         modules_success = []
         modules_failure = []
+        modules_lazy = []
+        lazy = self.lazy_config()
 
         for module_name,_ in modules_to_load:
-            if self.load_module(module_name):
-                modules_success.append(module_name)
+            if module_name in lazy:
+                # Nothing is imported yet; we just listen for the events
+                # which will load it, and hold its place in the ordering.
+                self.lazy_modules[module_name] = lazy[module_name]
+                self.module_ordering.append(module_name)
+                for event in lazy[module_name]:
+                    self.listen(event)
+                modules_lazy.append(module_name)
             else:
-                modules_failure.append(module_name)
+                started = time.time()
+                if self.load_module(module_name):
+                    modules_success.append(module_name)
+                    self.startup_times[module_name] = {
+                        "load": time.time() - started}
+                else:
+                    modules_failure.append(module_name)
 
         if modules_success:
             _log.info("Loaded the following modules: %s", modules_success)
+        if modules_lazy:
+            _log.info("These modules will be loaded when needed: %s",
+                      modules_lazy)
+
+        self.module_ordering = self.order_modules(self.module_ordering)
+        for module_name in self.held_back(modules_success, modules_failure):
+            modules_success.remove(module_name)
+            modules_failure.append(module_name)
+            del self.loaded_modules[module_name]
+            self.module_ordering.remove(module_name)
+
+        for module_name in modules_success:
+            if states.get(module_name) is not None:
+                try:
+                    self.loaded_modules[module_name].import_state(
+                        states[module_name])
+                except Exception:
+                    _log.exception("Module '%s' was unable to import its "
+                                   "state; it will start afresh.", module_name)
+
+        for module_name in self.warm_up_modules(modules_success):
+            modules_failure.append(module_name)
+            del self.loaded_modules[module_name]
+            self.module_ordering.remove(module_name)
         if modules_failure:
             _log.error("These modules failed to load: %s", modules_failure)
 
         for module_name in self.module_ordering:
-            module = self.loaded_modules[module_name]
+            module = self.loaded_modules.get(module_name)
+            if module is None:
+                continue
+            started = time.time()
             module.start(reloading=(module_name in old_modules))
+            self.startup_times[module_name]["start"] = time.time() - started
+        self.log_startup_times(modules_success)
 
         self.process_event("STARTUP", self.client, (), force_dispatch=True)
 
         return not modules_failure
 
+    def order_modules(self, module_names):
+        """Order modules so that each comes after those it requires.
+
+        Amongst modules which don't depend on one another, those with a
+        lower priority in the config come first, then those listed earlier
+        in it, so the ordering is always the same for the same config.
+        Lazy modules aren't loaded yet, so their requirements can't be
+        known; they're placed by priority alone. Dependency cycles and
+        missing requirements are logged, and otherwise ignored here (but
+        see held_back()).
+        """
+        try:
+            priorities = self.module_priorities(self.config)
+        except ValueError:
+            priorities = {}
+        appearance = dict((name, i) for i, (name, _) in
+                          enumerate(self.config.items("modules")))
+        def key(name):
+            return (priorities.get(name, sys.maxint),
+                    appearance.get(name, sys.maxint), name)
+
+        providers = {}
+        for name in module_names:
+            module = self.loaded_modules.get(name)
+            provides = getattr(module, "provides", ())
+            for thing in (name,) + tuple(provides):
+                providers.setdefault(thing, set()).add(name)
+
+        self.dependencies = {}
+        self.missing_requirements = {}
+        dependents = {} # module -> modules waiting for it
+        for name in module_names:
+            module = self.loaded_modules.get(name)
+            required = self.dependencies[name] = set()
+            for thing in getattr(module, "requires", ()):
+                if thing not in providers:
+                    _log.warning("Module '%s' requires '%s', which no "
+                                 "loaded module provides.", name, thing)
+                    self.missing_requirements.setdefault(name, set()).add(
+                        thing)
+                    continue
+                for provider in providers[thing] - set([name]):
+                    required.add(provider)
+                    dependents.setdefault(provider, set()).add(name)
+        waiting_on = dict((name, set(required)) for name, required
+                          in self.dependencies.iteritems())
+
+        ready = [key(name) for name in module_names if not waiting_on[name]]
+        heapq.heapify(ready)
+        ordering = []
+        while ready:
+            name = heapq.heappop(ready)[-1]
+            ordering.append(name)
+            for dependent in dependents.get(name, ()):
+                waiting_on[dependent].discard(name)
+                if not waiting_on[dependent]:
+                    heapq.heappush(ready, key(dependent))
+
+        if len(ordering) < len(module_names):
+            left = sorted((name for name in module_names
+                           if name not in ordering), key=key)
+            _log.error("Modules with circular dependencies, ordered by "
+                       "priority instead: %s", left)
+            ordering.extend(left)
+        return ordering
+
+    def held_back(self, module_names, failed):
+        """Find which modules can't be started since something they require
+        failed to load.
+
+        As far as the modules' requirements go, a module which failed to
+        load might have provided anything; so if any did (i.e. 'failed' is
+        not empty), a requirement that no loaded module provides holds a
+        module back, as does requiring a module which is itself held back.
+        This is the same rule as warm_up_modules() applies to modules whose
+        warm_up() fails. The modules must already have been ordered with
+        order_modules().
+        """
+        if not failed:
+            return []
+        held = []
+        for name in self.module_ordering:
+            if name not in module_names:
+                continue
+            if self.missing_requirements.get(name) or \
+                    self.dependencies.get(name, set()).intersection(held):
+                _log.error("Not starting module '%s', since a module it "
+                           "requires failed.", name)
+                held.append(name)
+        return held
+
+    def warm_up_modules(self, module_names):
+        """Call warm_up() on modules, concurrently where possible.
+
+        Each module's warm_up() is run once those of the modules it
+        requires have finished, on a pool of .startup_threads threads.
+        Returns a list of modules whose warm_up() failed (or which required
+        a module whose warm_up() failed). The modules must already have been
+        ordered with order_modules().
+        """
+        module_names = [name for name in self.module_ordering
+                        if name in module_names]
+        if not module_names:
+            return []
+        position = dict((name, i) for i, name in
+                        enumerate(self.module_ordering))
+
+        # Modules are warmed up in waves: each wave is the modules whose
+        # requirements were all in earlier waves.
+        waves = {}
+        wave_of = {}
+        for name in module_names:
+            required = self.dependencies.get(name, set()).intersection(
+                module_names)
+            # Anything required comes earlier in the ordering, unless
+            # there's a cycle - which is ignored here too.
+            wave = 0
+            for other in required:
+                if position[other] < position[name]:
+                    wave = max(wave, wave_of[other] + 1)
+            wave_of[name] = wave
+            waves.setdefault(wave, []).append((name, required))
+
+        def warm_up(name):
+            started = time.time()
+            try:
+                self.loaded_modules[name].warm_up()
+            except Exception:
+                _log.exception("Failed to warm up module '%s'.", name)
+                return False
+            finally:
+                self.startup_times.setdefault(name, {})["warm_up"] = \
+                    time.time() - started
+            return True
+
+        failed = []
+        pool = None # Only started if there's something to run concurrently
+        try:
+            for wave in sorted(waves):
+                names = []
+                for name, required in waves[wave]:
+                    if required.intersection(failed):
+                        _log.error("Not starting module '%s', since a "
+                                   "module it requires failed.", name)
+                        failed.append(name)
+                    elif (type(self.loaded_modules[name]).warm_up.im_func is
+                          Module.warm_up.im_func):
+                        # Nothing to do
+                        self.startup_times.setdefault(name, {})["warm_up"] = 0
+                    else:
+                        names.append(name)
+                if len(names) > 1 and self.startup_threads > 1:
+                    if pool is None:
+                        pool = ThreadPool(min(self.startup_threads,
+                                              len(module_names)))
+                    results = pool.map(warm_up, names)
+                else:
+                    results = map(warm_up, names)
+                failed.extend(name for name, ok in zip(names, results)
+                              if not ok)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return failed
+
+    def log_startup_times(self, module_names):
+        for name in module_names:
+            times = self.startup_times.get(name)
+            if not times or "start" not in times:
+                continue
+            _log.info("Module '%s' started in %.3fs (load %.3fs, warm up "
+                      "%.3fs, start %.3fs).", name, sum(times.values()),
+                      times.get("load", 0), times.get("warm_up", 0),
+                      times["start"])
+
+    def module_priorities(self, config):
+        """Read the [modules] section of a config: module name -> priority.
+
+        Raises ValueError if any of the priorities aren't integers.
+        """
+        return dict((module_name, int(priority))
+                    for module_name, priority in config.items("modules"))
+
+    def update_modules(self, old_config):
+        """Apply the changes to the configured modules since old_config.
+
+        1. Calls stop() on, and unloads, each module no longer configured
+        2. Loads each newly configured module (unless it's lazy - see
+           reload_modules())
+        3. Reorders the modules by their dependencies and new priorities
+        4. Calls warm_up() and then start(reloading=False) on each newly
+           loaded module
+        5. Dispatches the STARTUP event to the newly loaded modules only
+
+        Modules which are still configured keep running as they were,
+        state and all. Lazy modules not yet loaded pick up any change to
+        their events, and are loaded now if they're no longer lazy.
+
+        Returns True if all new modules loaded successfully, otherwise False.
+        """
+        try:
+            old = self.module_priorities(old_config)
+        except ValueError:
+            old = {}
+        try:
+            new = self.module_priorities(self.config)
+        except ValueError:
+            _log.exception("Unable to update modules due to invalid priority.")
+            return False
+
+        self.reload_count += 1
+        removed = [name for name in self.module_ordering if name not in new]
+        added = [name for name, _ in self.config.items("modules")
+                 if name not in self.loaded_modules and
+                 name not in self.lazy_modules]
+        lazy = self.lazy_config()
+
+        for module_name in removed:
+            self.unload_module(module_name)
+
+        for module_name, events in self.lazy_modules.items():
+            if module_name in lazy:
+                self.lazy_modules[module_name] = lazy[module_name]
+                for event in lazy[module_name]:
+                    self.listen(event)
+            else:
+                del self.lazy_modules[module_name]
+                added.append(module_name)
+
+        modules_success = []
+        modules_failure = []
+        for module_name in added:
+            if module_name in lazy:
+                self.lazy_modules[module_name] = lazy[module_name]
+                if module_name not in self.module_ordering:
+                    self.module_ordering.append(module_name)
+                for event in lazy[module_name]:
+                    self.listen(event)
+            else:
+                started = time.time()
+                if self.load_module(module_name):
+                    modules_success.append(module_name)
+                    self.startup_times[module_name] = {
+                        "load": time.time() - started}
+                else:
+                    modules_failure.append(module_name)
+                    if module_name in self.module_ordering:
+                        self.module_ordering.remove(module_name)
+
+        # Same ordering (and holding back) as reload_modules()
+        self.module_ordering = self.order_modules(self.module_ordering)
+        for module_name in self.held_back(modules_success, modules_failure):
+            modules_success.remove(module_name)
+            modules_failure.append(module_name)
+            del self.loaded_modules[module_name]
+            self.module_ordering.remove(module_name)
+        for module_name in self.warm_up_modules(modules_success):
+            modules_success.remove(module_name)
+            modules_failure.append(module_name)
+            del self.loaded_modules[module_name]
+            self.module_ordering.remove(module_name)
+
+        changed = [name for name in self.module_ordering
+                   if name in old and old[name] != new[name]]
+        if removed:
+            _log.info("Unloaded the following modules: %s", removed)
+        if modules_success:
+            _log.info("Loaded the following modules: %s", modules_success)
+        if modules_failure:
+            _log.error("These modules failed to load: %s", modules_failure)
+        if changed:
+            _log.info("Changed the priority of the following modules: %s",
+                      changed)
+
+        for module_name in self.module_ordering:
+            if module_name in modules_success:
+                started = time.time()
+                self.loaded_modules[module_name].start(reloading=False)
+                self.startup_times[module_name]["start"] = \
+                    time.time() - started
+        self.log_startup_times(modules_success)
+        if self.running:
+            for module_name in modules_success:
+                module = self.loaded_modules.get(module_name)
+                if module is not None:
+                    module.handle_event("STARTUP", self.client, ())
+
+        return not modules_failure
+
     def reload_module(self, module_name):
         """Reloads the specified module without changing its ordering.
 
-        1. Calls stop(reloading=True) on the module
-        2. Reloads the Module object into .loaded_modules
-        3. Calls start(reloading=True) on the new object
-        
+        (Unless what the module requires has changed, in which case the
+        modules are reordered accordingly.)
+
+        1. Calls export_state() on the module
+        2. Loads a new Module object into .loaded_modules, and calls
+           import_state() with the exported state (if any) and warm_up()
+           on it
+        3. Calls stop(reloading=True) on the old object, and then
+           start(reloading=True) on the new one
+
+        If the new object can't be created, or fails to import the state or
+        to warm up, the old object is put back and carries on as it was. If
+        the new object fails to start, it is stopped again and the old
+        object is put back and started again (or unloaded, if that fails).
+
         If called with a module name that is not currently loaded, it will load it.
 
         Returns True if the module was successfully reloaded, otherwise False.
         """
+        self.reload_count += 1
         module = self.loaded_modules.get(module_name)
+        previous = sys.modules.get(module_name)
+        state = None
         if module:
-            module.stop(reloading=True)
+            state = self.export_module_state(module_name, module)
         else:
             _log.info("Reload loading new module module '%s'",
                          module_name)
-        success = self.load_module(module_name)
-        if success:
+
+        new_module = None
+        try:
+            if self.load_module(module_name):
+                new_module = self.loaded_modules[module_name]
+                if state is not None:
+                    new_module.import_state(state)
+                new_module.warm_up()
+        except Exception:
+            _log.exception("Unable to load module '%s'.", module_name)
+            new_module = None
+
+        if new_module is None:
+            # The old object was never stopped, so it can just carry on.
+            self.restore_module(module_name, module, previous)
+            return False
+
+        if module:
+            try:
+                module.stop(reloading=True)
+            except Exception:
+                _log.exception("Error stopping module '%s'.", module_name)
+
+        try:
+            new_module.start(reloading=True)
+        except Exception:
+            _log.exception("Reloaded module '%s' failed to start.",
+                           module_name)
+            try:
+                new_module.stop(reloading=True)
+            except Exception:
+                _log.exception("Error stopping module '%s'.", module_name)
+        else:
             _log.info("Successfully (re)loaded module '%s'.", module_name)
-        elif module:
+            # Its requirements may have changed
+            self.module_ordering = self.order_modules(self.module_ordering)
+            return True
+
+        self.restore_module(module_name, module, previous)
+        if module:
+            try:
+                module.start(reloading=True)
+            except Exception:
+                _log.exception("Unable to restart module '%s'; unloading it.",
+                               module_name)
+                self.loaded_modules.pop(module_name, None)
+                if module_name in self.module_ordering:
+                    self.module_ordering.remove(module_name)
+        return False
+
+    def restore_module(self, module_name, module, previous):
+        """Put back a module (and its import) after a failed reload.
+
+        If module is None (there was no old object), whatever was loaded
+        in its place is removed instead.
+        """
+        if module:
             _log.error("Unable to reload module '%s', reusing existing.",
                        module_name)
+            self.loaded_modules[module_name] = module
         else:
             _log.error("Failed to load module '%s'.", module_name)
-            return False
-        self.loaded_modules[module_name].start(reloading=True)
-        return success
+            self.loaded_modules.pop(module_name, None)
+            if module_name in self.module_ordering:
+                self.module_ordering.remove(module_name)
+        self.restore_import(module_name, previous)
+
+    def restore_import(self, module_name, previous):
+        """Make a previously imported copy of a Python module current again.
+
+        If previous is None (it hadn't been imported before), any copy
+        imported since is forgotten.
+        """
+        if previous is None:
+            sys.modules.pop(module_name, None)
+            return
+        sys.modules[module_name] = previous
+        package, _, name = module_name.rpartition(".")
+        if package in sys.modules:
+            setattr(sys.modules[package], name, previous)
+
+    def export_module_state(self, module_name, module):
+        """Call a module's export_state(), logging (and ignoring) errors."""
+        try:
+            return module.export_state()
+        except Exception:
+            _log.exception("Unable to export the state of module '%s'; "
+                           "it will start afresh.", module_name)
+            return None
 
     def load_module(self, module_name):
         """Attempts to load the specified module.
@@ -323,17 +1038,28 @@ class Controller(object):
             if self.loaded_on_this_event is not None:
                 self.loaded_on_this_event.add(module_name)
 
-            # Force the module to actually be reloaded
+            # Import a fresh copy of the module (if it had already been
+            # imported; otherwise importing it is enough). Rather than
+            # reload(), which re-runs the code in the old copy's namespace,
+            # the old copy is left untouched - objects created from it may
+            # still be running, and rely on its names (for super(), say) -
+            # and put back if the new copy can't be loaded.
+            previous = sys.modules.pop(module_name, None)
             try:
-                _temp = reload(importlib.import_module(module_name))
+                _temp = importlib.import_module(module_name)
             except ImportError:
+                self.restore_import(module_name, previous)
                 _log.error("Unable to load module '%s' - module not found.",
                            module_name)
                 return False
             except SyntaxError:
+                self.restore_import(module_name, previous)
                 _log.exception("Unable to load module '%s' - syntax error(s).",
                            module_name)
                 return False
+            except Exception:
+                self.restore_import(module_name, previous)
+                raise
 
             if not hasattr(_temp, "module"):
                 _log.error("Unable to load module '%s' - no 'module' member.",
@@ -347,6 +1073,7 @@ class Controller(object):
                 return False
 
             self.loaded_modules[module_name] = module(self)
+            self.lazy_modules.pop(module_name, None)
             if module_name not in self.module_ordering:
                 self.module_ordering.append(module_name)
             return True
@@ -356,6 +1083,10 @@ class Controller(object):
 
     def unload_module(self, module_name):
         """Unload the specified module, if it is loaded."""
+        if module_name in self.lazy_modules:
+            del self.lazy_modules[module_name]
+            self.module_ordering.remove(module_name)
+            return True
         module = self.loaded_modules.get(module_name)
         if not module:
             _log.warning("Ignoring request to unload non-existant module '%s'",
@@ -0,0 +1,237 @@
+import logging
+import socket
+import time
+
+try:
+    import ssl as _ssl
+    _hush_pyflakes = [_ssl]
+    del _hush_pyflakes
+except ImportError:
+    _ssl = None # No SSL support
+
+_log = logging.getLogger(__name__)
+
+# Whether this Python's ssl module can resume TLS sessions.
+HAS_SESSIONS = _ssl is not None and hasattr(_ssl, "SSLSession")
+
+
+class Transport(object):
+    """A byte stream connection to an IRC server.
+
+    Subclasses are responsible for creating and connecting self.socket in
+    connect(); everything else (buffered writes, reads, closing) is shared.
+
+    Outgoing data is buffered by write() and only handed to the socket by
+    flush(), which allows several lines to be sent in a single syscall.
+    """
+
+    def __init__(self, host, port=None):
+        self.host = host
+        self.port = port
+        self.socket = None
+        self._outgoing = []
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (type(self).__name__, self.host, self.port)
+
+    def connect(self):
+        """Open the connection. Must be implemented by subclasses."""
+        raise NotImplementedError
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv(self, size=4096):
+        """Read up to 'size' bytes; returns an empty string on EOF."""
+        return self.socket.recv(size)
+
+    def has_buffered(self):
+        """Whether data can be read without waiting for the socket.
+
+        (Data can be buffered internally by e.g. TLS, where select() won't
+        see it.)
+        """
+        return False
+
+    def write(self, data):
+        """Add data to the outgoing buffer without sending it yet."""
+        self._outgoing.append(data)
+
+    @property
+    def pending(self):
+        """The number of writes waiting to be flushed."""
+        return len(self._outgoing)
+
+    def flush(self):
+        """Send everything in the outgoing buffer in a single write."""
+        if not self._outgoing:
+            return
+        data = "".join(self._outgoing)
+        self._outgoing = []
+        self.socket.sendall(data)
+
+    def close(self):
+        self._outgoing = []
+        if self.socket is None:
+            return
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class TCPTransport(Transport):
+    """A plain TCP connection."""
+
+    def connect(self):
+        self.socket = socket.create_connection((self.host, self.port))
+
+
+class SSLTransport(TCPTransport):
+    """A TLS connection, set up through an ssl.SSLContext.
+
+    'context' may be an existing SSLContext (which lets settings be shared
+    between connections); if omitted, one is created from 'ssl_kwargs',
+    which accepts the same arguments as the old ssl.wrap_socket() call
+    (keyfile, certfile, cert_reqs, ca_certs, ssl_version, ciphers).
+
+    'session' may be the .session of an earlier connection made with the
+    same context, in which case the server is asked to resume it rather
+    than doing a full handshake. (Session resumption requires a Python
+    with ssl.SSLSession support; elsewhere the argument is ignored.)
+
+    After connect(), .handshake_time holds the duration of the TLS
+    handshake in seconds and .session_reused whether it was resumed.
+    """
+
+    def __init__(self, host, port=None, context=None, session=None,
+                 **ssl_kwargs):
+        super(SSLTransport, self).__init__(host, port)
+        if _ssl is None:
+            raise ValueError("SSL requested but no SSL support available!")
+        self.context = context or make_ssl_context(**ssl_kwargs)
+        self.handshake_time = None
+        self.session_reused = False
+        self._session = session
+
+    def connect(self):
+        super(SSLTransport, self).connect()
+        wrap_kwargs = {
+            "server_hostname": self.host if _ssl.HAS_SNI else None,
+            "do_handshake_on_connect": False,
+        }
+        if self._session is not None and HAS_SESSIONS:
+            wrap_kwargs["session"] = self._session
+        self.socket = self.context.wrap_socket(self.socket, **wrap_kwargs)
+
+        start = time.time()
+        self.socket.do_handshake()
+        self.handshake_time = time.time() - start
+        self.session_reused = bool(getattr(self.socket, "session_reused",
+                                           False))
+        _log.debug("TLS handshake with %s took %.3fs (resumed: %s)",
+                   self.host, self.handshake_time, self.session_reused)
+
+    def has_buffered(self):
+        return self.socket.pending() > 0
+
+    @property
+    def session(self):
+        """The TLS session of this connection, for resuming it later.
+
+        This is read as late as possible (servers using TLS 1.3 only hand
+        out session tickets after the handshake), and is still available
+        after the transport is closed.
+        """
+        if self.socket is not None:
+            self._session = getattr(self.socket, "session", None)
+        return self._session
+
+    def close(self):
+        # Capture the session before the socket goes away.
+        self._session = self.session
+        super(SSLTransport, self).close()
+        self.socket = None
+
+
+class UnixTransport(Transport):
+    """A connection over a Unix domain socket (e.g. to a local bouncer).
+
+    The socket path is stored as the transport's host.
+    """
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.host)
+
+
+class MemoryTransport(Transport):
+    """An in-memory connection, mostly useful for testing.
+
+    Connecting creates a local socket pair; the far end is available as
+    .peer, so a test can write server lines to it and read back whatever
+    the client sent:
+
+        transport = MemoryTransport()
+        client.connect("bot", transport=transport)
+        transport.peer.sendall(":server 001 bot :Welcome\\r\\n")
+    """
+
+    def __init__(self, host="memory", port=None):
+        super(MemoryTransport, self).__init__(host, port)
+        self.peer = None
+
+    def connect(self):
+        self.socket, self.peer = socket.socketpair()
+
+    def close(self):
+        super(MemoryTransport, self).close()
+        if self.peer is not None:
+            self.peer.close()
+            self.peer = None
+
+
+def make_ssl_context(keyfile=None, certfile=None, cert_reqs=None,
+                     ca_certs=None, ssl_version=None, ciphers=None):
+    """Build an SSLContext from ssl.wrap_socket()-style arguments.
+
+    As with wrap_socket(), certificates are not verified unless cert_reqs
+    says otherwise.
+    """
+    if _ssl is None:
+        raise ValueError("SSL requested but no SSL support available!")
+    if ssl_version is None:
+        ssl_version = _ssl.PROTOCOL_SSLv23
+    context = _ssl.SSLContext(ssl_version)
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    if cert_reqs is not None:
+        context.verify_mode = cert_reqs
+    if ca_certs:
+        context.load_verify_locations(ca_certs)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return context
+
+
+def is_ssl_context(obj):
+    """Whether obj is an ssl.SSLContext."""
+    return _ssl is not None and isinstance(obj, _ssl.SSLContext)
+
+
+def make_transport(host, port, ssl=None, session=None):
+    """Create an (unconnected) transport for a host/port pair.
+
+    The 'ssl' argument works as in Client.connect(): boolean true selects
+    TLS, a dictionary selects TLS with those wrap_socket()-style arguments,
+    and an ssl.SSLContext selects TLS using that context. 'session' is
+    passed on to SSLTransport when TLS is used.
+    """
+    if not ssl:
+        return TCPTransport(host, port)
+    if is_ssl_context(ssl):
+        return SSLTransport(host, port, context=ssl, session=session)
+    ssl_kwargs = ssl if isinstance(ssl, dict) else {}
+    return SSLTransport(host, port, session=session, **ssl_kwargs)
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -1,3 +1,6 @@
+import re
+
+
 def split_hostmask(hostmask):
     """Splits a nick@host string into nick and host."""
     nick, _, host = hostmask.partition('@')
@@ -55,4 +58,144 @@ class User(object):
     def __repr__(self):
         return "kitnirc.user.User(%s)" % str(self)
 
+
+def normalize_mask(mask):
+    """Fill in the missing parts of a hostmask with wildcards.
+
+    "nick" becomes "nick!*@*", and "nick@host" becomes "nick!*@host".
+    """
+    nick, user, host = split_hostmask(mask)
+    return "%s!%s@%s" % (nick or "*", user or "*", host or "*")
+
+
+def mask_key(user):
+    """The lowercased nick!user@host of a User (or hostmask string), with
+    any unknown parts left empty, for matching against masks."""
+    if not isinstance(user, User):
+        user = User(user)
+    return "%s!%s@%s" % (user.nick.lower(), (user.username or "").lower(),
+                         (user.host or "").lower())
+
+
+def is_wildcard(mask):
+    return "*" in mask or "?" in mask
+
+
+def mask_to_regex(mask):
+    """Translate a hostmask with * and ? wildcards into a regex pattern.
+
+    The pattern is unanchored and matches lowercased keys (see mask_key()).
+    """
+    pattern = re.escape(normalize_mask(mask).lower())
+    return pattern.replace(r"\*", ".*").replace(r"\?", ".")
+
+
+def compile_mask(mask):
+    """Compile a hostmask into a regex which matches whole mask keys."""
+    return re.compile(mask_to_regex(mask) + r"\Z")
+
+
+class MaskIndex(object):
+    """A set of hostmasks, indexed for matching users against all of them.
+
+    Masks without wildcards are kept in a dictionary, as are masks which
+    match everyone on one host (*!*@host, the most common shape of ban),
+    so matching them is a single lookup. The rest are combined into one
+    regex (compiled when first needed after a change), so a user can be
+    checked against all of them in a single pass rather than one fnmatch
+    per mask.
+
+    Masks are compared case-insensitively (using ASCII case rules) and
+    missing parts are treated as wildcards (see normalize_mask()).
+    """
+
+    def __init__(self, masks=()):
+        self.exact = {} # normalized mask -> mask as given
+        self.hosts = {} # host -> mask as given, for *!*@host masks
+        self.wildcards = {} # normalized mask -> mask as given
+        self._patterns = {} # normalized mask -> compiled regex
+        self._combined = None
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self.exact) + len(self.hosts) + len(self.wildcards)
+
+    def __iter__(self):
+        return iter(self.exact.values() + self.hosts.values() +
+                    self.wildcards.values())
+
+    def __contains__(self, mask):
+        key = normalize_mask(mask).lower()
+        return (key in self.exact or key in self.wildcards or
+                (key.startswith("*!*@") and key[4:] in self.hosts))
+
+    def add(self, mask):
+        key = normalize_mask(mask).lower()
+        if not is_wildcard(key):
+            self.exact[key] = mask
+        elif key.startswith("*!*@") and not is_wildcard(key[4:]):
+            self.hosts[key[4:]] = mask
+        else:
+            self.wildcards[key] = mask
+            self._combined = None
+
+    def discard(self, mask):
+        key = normalize_mask(mask).lower()
+        if self.exact.pop(key, None) is not None:
+            return
+        if key.startswith("*!*@") and self.hosts.pop(key[4:], None):
+            return
+        if self.wildcards.pop(key, None) is not None:
+            self._patterns.pop(key, None)
+            self._combined = None
+
+    def clear(self):
+        self.exact.clear()
+        self.hosts.clear()
+        self.wildcards.clear()
+        self._patterns.clear()
+        self._combined = None
+
+    def _matches_key(self, key):
+        if key in self.exact or key.rpartition("@")[2] in self.hosts:
+            return True
+        if not self.wildcards:
+            return False
+        if self._combined is None:
+            self._combined = re.compile(r"(?:%s)\Z" % "|".join(
+                mask_to_regex(mask) for mask in self.wildcards))
+        return self._combined.match(key) is not None
+
+    def matches(self, user):
+        """Whether any mask in the index matches the user."""
+        return self._matches_key(mask_key(user))
+
+    def matching(self, user):
+        """A list of the masks (as given) which match the user."""
+        key = mask_key(user)
+        result = []
+        if key in self.exact:
+            result.append(self.exact[key])
+        host = key.rpartition("@")[2]
+        if host in self.hosts:
+            result.append(self.hosts[host])
+        if self.wildcards and self._matches_key(key):
+            for mask, original in self.wildcards.iteritems():
+                pattern = self._patterns.get(mask)
+                if pattern is None:
+                    pattern = self._patterns[mask] = compile_mask(mask)
+                if pattern.match(key):
+                    result.append(original)
+        return result
+
+
+def users_matching(mask, users):
+    """The users (Users or hostmask strings) which match a hostmask."""
+    if not is_wildcard(mask):
+        key = normalize_mask(mask).lower()
+        return [user for user in users if mask_key(user) == key]
+    pattern = compile_mask(mask)
+    return [user for user in users if pattern.match(mask_key(user))]
+
 # vim: set ts=4 sts=4 sw=4 et:
@@ -93,6 +93,15 @@ def main():
     username = args.username or config_or_none("server", "username") or nick
     realname = args.realname or config_or_none("server", "realname") or username
 
+    # SASL authentication during registration, if configured
+    sasl = None
+    sasl_mechanism = config_or_none("server", "sasl_mechanism") or "PLAIN"
+    if sasl_mechanism.upper() == "EXTERNAL":
+        sasl = "EXTERNAL"
+    elif config_or_none("server", "sasl_password"):
+        sasl = (config_or_none("server", "sasl_account") or nick,
+                config_or_none("server", "sasl_password"))
+
     controller.start()
     client.connect(
         nick,
@@ -102,6 +111,7 @@ def main():
         realname=realname,
         password=password,
         ssl=ssl,
+        sasl=sasl,
     )
     try:
         client.run()
@@ -9,6 +9,10 @@ _log = logging.getLogger(__name__)
 class BananasModule(Module):
     """A basic KitnIRC module which registers commands."""
 
+    # Start after the module which provides commands, so that they can be
+    # registered straight away.
+    requires = ("commands",)
+
     def add_command(self, client, command, event, helptext=None):
         self.trigger_event("ADDCOMMAND", client, [command, event, helptext])
 